@@ -46,6 +46,9 @@ many of the difficult problems for you, making the task of building
 sophisticated high-performance network servers and clients a snap.
 """
 
+import collections
+import heapq
+import itertools
 import select
 import socket
 import sys
@@ -54,7 +57,7 @@ import warnings
 
 import os
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, EINVAL, \
-    ENOTCONN, ESHUTDOWN, EISCONN, EINTR, EBADF, ECONNABORTED, EPIPE, EAGAIN, \
+    ENOTCONN, ESHUTDOWN, EISCONN, EBADF, ECONNABORTED, EPIPE, EAGAIN, \
     errorcode
 
 _DISCONNECTED = frozenset((ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE,
@@ -210,29 +213,141 @@ poll = select_poller
 poll2 = poll3 = poll_poller
 
 
+class epoll_pollster:
+    """A persistent epoll object shared by all channels of one socket map.
+
+    File descriptors are registered once and their interest mask is only
+    modified when it actually changes, instead of building a new epoll
+    object on every loop iteration.
+
+    In edge-triggered mode every fd is registered once for both directions
+    and readiness reported by the kernel is remembered in ready_r/ready_w
+    until the dispatcher has drained the socket up to EWOULDBLOCK.
+
+    Exclusive fds are registered with EPOLLEXCLUSIVE, which the kernel
+    doesn't allow to be modified later: their mask stays EPOLLIN, and they
+    are taken out of the epoll set while their channel isn't readable.
+    """
+
+    def __init__(self, edge=False):
+        self._epoll = select.epoll()
+        self._pid = os.getpid()
+        self._flags = {}
+        self._exclusive = {}
+        self.edge = edge
+        self.ready_r = set()
+        self.ready_w = set()
+
+    def add(self, fd, exclusive=False):
+        if exclusive:
+            flags = select.EPOLLIN | select.EPOLLEXCLUSIVE
+            if self.edge:
+                flags |= select.EPOLLET
+            self.unregister(fd)
+            self.register(fd, flags)
+            self._exclusive[fd] = flags
+        elif self.edge:
+            self.register(fd, _EDGE_FLAGS)
+        else:
+            # the real interest mask is set by the poller
+            self.register(fd, 0)
+
+    def register(self, fd, flags):
+        if fd in self._flags:
+            self.modify(fd, flags)
+            return
+        self._epoll.register(fd, flags)
+        self._flags[fd] = flags
+
+    def modify(self, fd, flags):
+        exclusive = self._exclusive.get(fd)
+        if exclusive is not None:
+            flags = exclusive if flags else 0
+            if self._flags.get(fd) != flags:
+                if flags:
+                    self._epoll.register(fd, flags)
+                else:
+                    self._epoll.unregister(fd)
+                self._flags[fd] = flags
+            return
+        if self._flags.get(fd) != flags:
+            try:
+                self._epoll.modify(fd, flags)
+            except FileNotFoundError:
+                # the fd was closed behind our back and reused
+                self._epoll.register(fd, flags)
+            self._flags[fd] = flags
+
+    def unregister(self, fd):
+        self.ready_r.discard(fd)
+        self.ready_w.discard(fd)
+        self._exclusive.pop(fd, None)
+        if self._flags.pop(fd, None) is None:
+            return
+        try:
+            self._epoll.unregister(fd)
+        except (OSError, ValueError):
+            # the fd may already be closed
+            pass
+
+    def poll(self, timeout):
+        try:
+            return self._epoll.poll(timeout)
+        except InterruptedError:
+            return []
+
+    def close(self):
+        self._flags.clear()
+        self._exclusive.clear()
+        self.ready_r.clear()
+        self.ready_w.clear()
+        self._epoll.close()
+
+
+if hasattr(select, 'epoll'):
+    _EDGE_FLAGS = (select.EPOLLIN | select.EPOLLPRI | select.EPOLLOUT |
+                   select.EPOLLRDHUP | select.EPOLLET)
+
+# Maps id(socket map) to its epoll_pollster.
+_pollsters = {}
+
+
+def _get_pollster(map, create=True, edge=False):
+    pollster = _pollsters.get(id(map))
+    if pollster is not None and (pollster._pid != os.getpid() or
+                                 create and pollster.edge != edge):
+        # a pollster inherited across fork() shares its epoll instance with
+        # the parent process and must not be used by the child
+        pollster.close()
+        pollster = None
+        del _pollsters[id(map)]
+    if pollster is None and create:
+        pollster = _pollsters[id(map)] = epoll_pollster(edge)
+        for fd, obj in map.items():
+            pollster.add(fd, obj.poll_exclusive)
+    return pollster
+
+
+def _epoll_flags(obj):
+    flags = 0
+    if obj.readable():
+        flags |= select.POLLIN | select.POLLPRI
+    # accepting sockets should not be writable
+    if obj.writable() and not obj.accepting:
+        flags |= select.POLLOUT
+    return flags
+
+
 def epoll_poller(timeout=0.0, map=None):
     """A poller which uses epoll(), supported on Linux 2.5.44 and newer."""
     if map is None:
         map = socket_map
-    pollster = select.epoll()
     if map:
+        pollster = _get_pollster(map)
         for fd, obj in map.items():
-            flags = 0
-            if obj.readable():
-                flags |= select.POLLIN | select.POLLPRI
-            if obj.writable():
-                flags |= select.POLLOUT
-            if flags:
-                # Only check for exceptions if object was either readable
-                # or writable.
-                flags |= select.POLLERR | select.POLLHUP | select.POLLNVAL
-                pollster.register(fd, flags)
-        try:
-            r = pollster.poll(timeout)
-        except select.error as err:
-            if err.args[0] != EINTR:
-                raise
-            r = []
+            # errors and hangups are always reported by epoll
+            pollster.modify(fd, _epoll_flags(obj))
+        r = pollster.poll(timeout)
         for fd, flags in r:
             obj = map.get(fd)
             if obj is None:
@@ -240,6 +355,78 @@ def epoll_poller(timeout=0.0, map=None):
             readwrite(obj, flags)
 
 
+def _drain(obj, drain):
+    try:
+        return drain()
+    except socket.error as e:
+        if e.args[0] not in _DISCONNECTED:
+            obj.handle_error()
+        else:
+            obj.handle_close()
+    except _reraised_exceptions:
+        raise
+    except:
+        obj.handle_error()
+    return True
+
+
+def epoll_et_poller(timeout=0.0, map=None):
+    """An edge-triggered (EPOLLET) variant of epoll_poller().
+
+    No epoll_ctl() calls are made after a channel is added. Dispatchers are
+    expected to read and write until the socket would block, which
+    dispatcher.drain_read_event() and drain_write_event() take care of.
+    """
+    if map is None:
+        map = socket_map
+    if map:
+        pollster = _get_pollster(map, edge=True)
+        ready_r = pollster.ready_r
+        ready_w = pollster.ready_w
+        # exclusive fds are the only ones whose interest changes, so that
+        # other processes get their events while we can't take them
+        for fd in list(pollster._exclusive):
+            obj = map.get(fd)
+            if obj is not None:
+                pollster.modify(fd, _epoll_flags(obj))
+        # don't sleep while a ready channel is waiting for us
+        for fd in ready_r:
+            obj = map.get(fd)
+            if obj is not None and obj.readable():
+                timeout = 0
+                break
+        else:
+            for fd in ready_w:
+                obj = map.get(fd)
+                if obj is not None and obj.writable():
+                    timeout = 0
+                    break
+        for fd, flags in pollster.poll(timeout):
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            if flags & (select.EPOLLIN | select.EPOLLPRI | select.EPOLLRDHUP):
+                ready_r.add(fd)
+            elif flags & (select.POLLHUP | select.POLLERR):
+                readwrite(obj, flags)
+                continue
+            if flags & select.EPOLLOUT:
+                ready_w.add(fd)
+        for fd in list(ready_r):
+            obj = map.get(fd)
+            if obj is None:
+                ready_r.discard(fd)
+            elif obj.readable() and _drain(obj, obj.drain_read_event):
+                ready_r.discard(fd)
+        for fd in list(ready_w):
+            obj = map.get(fd)
+            if obj is None:
+                ready_w.discard(fd)
+            elif (obj.writable() and not obj.accepting and
+                  _drain(obj, obj.drain_write_event)):
+                ready_w.discard(fd)
+
+
 def kqueue_poller(timeout=0.0, map=None):
     """A poller which uses kqueue(), BSD specific."""
     if map is None:
@@ -272,6 +459,111 @@ def kqueue_poller(timeout=0.0, map=None):
         kqueue.close()
 
 
+# ---------------------------------------------------------------------------
+# scheduled callbacks, run by loop() between two polls
+# ---------------------------------------------------------------------------
+
+class timer:
+    """A callback scheduled with call_at() or call_later()."""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled', 'scheduled', '_seq')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        # still in the heap, see run_timers()
+        self.scheduled = True
+        self._seq = next(_timer_seq)
+
+    def __lt__(self, other):
+        return (self.when, self._seq) < (other.when, other._seq)
+
+    def __repr__(self):
+        return '<timer %r at %.3f%s>' % (self.callback, self.when,
+                                         ' cancelled' if self.cancelled else '')
+
+    def cancel(self):
+        global _cancelled_timers
+        if not self.cancelled:
+            self.cancelled = True
+            if not self.scheduled:
+                # already popped to be run
+                return
+            # the timer stays in the heap until it expires or the heap
+            # gets compacted
+            _cancelled_timers += 1
+            if _cancelled_timers > 64 and \
+                    _cancelled_timers * 2 > len(_timers):
+                _compact_timers()
+
+
+_timers = []
+_timer_seq = itertools.count()
+_cancelled_timers = 0
+
+
+def _compact_timers():
+    global _cancelled_timers
+    _timers[:] = [t for t in _timers if not t.cancelled]
+    heapq.heapify(_timers)
+    _cancelled_timers = 0
+
+
+def call_at(when, callback, *args):
+    """Schedule callback(*args) at time.monotonic() value `when`."""
+    t = timer(when, callback, args)
+    heapq.heappush(_timers, t)
+    return t
+
+
+def call_later(delay, callback, *args):
+    """Schedule callback(*args) in `delay` seconds."""
+    return call_at(time.monotonic() + delay, callback, *args)
+
+
+def timer_timeout(timeout):
+    """Shorten a poll timeout so that it expires with the next timer."""
+    global _cancelled_timers
+    while _timers and _timers[0].cancelled:
+        heapq.heappop(_timers).scheduled = False
+        _cancelled_timers -= 1
+    if not _timers:
+        return timeout
+    delay = max(0.0, _timers[0].when - time.monotonic())
+    if timeout is None or timeout < 0 or delay < timeout:
+        return delay
+    return timeout
+
+
+def run_timers():
+    """Run all callbacks whose time has come."""
+    global _cancelled_timers
+    now = time.monotonic()
+    due = []
+    while _timers and _timers[0].when <= now:
+        t = heapq.heappop(_timers)
+        t.scheduled = False
+        if t.cancelled:
+            _cancelled_timers -= 1
+        else:
+            due.append(t)
+    for t in due:
+        # a callback may have cancelled a later one
+        if t.cancelled:
+            continue
+        t.cancelled = True
+        try:
+            t.callback(*t.args)
+        except _reraised_exceptions:
+            raise
+        except:
+            nil, c, v, tbinfo = compact_traceback()
+            sys.stderr.write('error: uncaptured python exception in %r '
+                             '(%s:%s %s)\n' % (t, c, v, tbinfo))
+
+
 def loop(timeout=3.0, use_poll=False, map=None, count=None,
          poller=select_poller):
     if map is None:
@@ -286,20 +578,30 @@ def loop(timeout=3.0, use_poll=False, map=None, count=None,
 
     if count is None:
         while map:
-            poller(timeout, map)
+            poller(timer_timeout(timeout), map)
+            run_timers()
     else:
         while map and count > 0:
-            poller(timeout, map)
+            poller(timer_timeout(timeout), map)
+            run_timers()
             count = count - 1
 
 
 class dispatcher:
+    # Channels are slotted so that a server holding many connections
+    # doesn't pay for a __dict__ per connection; subclasses that don't
+    # declare __slots__ get one back as usual.
+    __slots__ = ('_map', '_fileno', 'socket', 'connected', 'accepting',
+                 'connecting', 'closing', 'addr', 'family_and_type',
+                 # set by recv()/accept() and send() when the socket
+                 # would block
+                 'read_blocked', 'write_blocked')
     debug = False
-    connected = False
-    accepting = False
-    connecting = False
-    closing = False
-    addr = None
+    # upper bound of handler calls per readiness event in edge-triggered mode
+    max_drain = 16
+    # register with EPOLLEXCLUSIVE: of the processes polling a socket they
+    # share, only one waiting in epoll_wait() is woken per event
+    poll_exclusive = False
     ignore_log_types = frozenset(['warning'])
 
     def __init__(self, sock=None, map=None):
@@ -309,6 +611,13 @@ class dispatcher:
             self._map = map
 
         self._fileno = None
+        self.connected = False
+        self.accepting = False
+        self.connecting = False
+        self.closing = False
+        self.addr = None
+        self.read_blocked = False
+        self.write_blocked = False
 
         if sock:
             # Set to nonblocking just to make sure for cases where we
@@ -354,6 +663,9 @@ class dispatcher:
         if map is None:
             map = self._map
         map[self._fileno] = self
+        pollster = _get_pollster(map, create=False)
+        if pollster is not None:
+            pollster.add(self._fileno, self.poll_exclusive)
 
     def del_channel(self, map=None):
         fd = self._fileno
@@ -362,6 +674,9 @@ class dispatcher:
         if fd in map:
             # self.log_info('closing channel %d:%s' % (fd, self))
             del map[fd]
+        pollster = _get_pollster(map, create=False)
+        if pollster is not None:
+            pollster.unregister(fd)
         self._fileno = None
 
     def create_socket(self, family=socket.AF_INET, type=socket.SOCK_STREAM):
@@ -434,7 +749,10 @@ class dispatcher:
         except TypeError:
             return None
         except socket.error as why:
-            if why.args[0] in (EWOULDBLOCK, ECONNABORTED, EAGAIN):
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self.read_blocked = True
+                return None
+            elif why.args[0] == ECONNABORTED:
                 return None
             else:
                 raise
@@ -446,7 +764,38 @@ class dispatcher:
             result = self.socket.send(data)
             return result
         except socket.error as why:
-            if why.args[0] == EWOULDBLOCK:
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self.write_blocked = True
+                return 0
+            elif why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+
+    def sendmsg(self, buffers):
+        # scatter/gather variant of send()
+        try:
+            result = self.socket.sendmsg(buffers)
+            return result
+        except socket.error as why:
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self.write_blocked = True
+                return 0
+            elif why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+
+    def sendfile(self, file, offset, count):
+        # send() for a region of a regular file, see file_chunk
+        try:
+            result = os.sendfile(self._fileno, file.fileno(), offset, count)
+            return result
+        except socket.error as why:
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self.write_blocked = True
                 return 0
             elif why.args[0] in _DISCONNECTED:
                 self.handle_close()
@@ -465,13 +814,34 @@ class dispatcher:
             else:
                 return data
         except socket.error as why:
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self.read_blocked = True
+                return b''
             # winsock sometimes raises ENOTCONN
-            if why.args[0] in _DISCONNECTED:
+            elif why.args[0] in _DISCONNECTED:
                 self.handle_close()
                 return b''
             else:
                 raise
 
+    def recv_into(self, buffer):
+        # Like recv() but into a caller provided, reusable buffer: returns
+        # the number of bytes received, 0 if there is nothing to read
+        try:
+            nbytes = self.socket.recv_into(buffer)
+            if not nbytes:
+                self.handle_close()
+            return nbytes
+        except socket.error as why:
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self.read_blocked = True
+                return 0
+            elif why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+
     def close(self):
         self.connected = False
         self.accepting = False
@@ -486,6 +856,9 @@ class dispatcher:
     # cheap inheritance, used to pass all other attribute
     # references to the underlying socket object.
     def __getattr__(self, attr):
+        if attr == 'socket':
+            # not set yet, don't look it up on itself
+            raise AttributeError(attr)
         try:
             retattr = getattr(self.socket, attr)
         except AttributeError:
@@ -520,6 +893,17 @@ class dispatcher:
         else:
             self.handle_read()
 
+    def drain_read_event(self):
+        # Used by edge-triggered pollers: call handle_read_event() until the
+        # socket would block. Returns False if data may still be pending.
+        self.read_blocked = False
+        for i in range(self.max_drain):
+            self.handle_read_event()
+            if self.read_blocked or self._fileno is None or \
+                    not self.readable():
+                break
+        return self.read_blocked or self._fileno is None
+
     def handle_connect_event(self):
         err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
         if err != 0:
@@ -539,6 +923,16 @@ class dispatcher:
                 self.handle_connect_event()
         self.handle_write()
 
+    def drain_write_event(self):
+        # Counterpart of drain_read_event() for the write side.
+        self.write_blocked = False
+        for i in range(self.max_drain):
+            self.handle_write_event()
+            if self.write_blocked or self._fileno is None or \
+                    not self.writable():
+                break
+        return self.write_blocked or self._fileno is None
+
     def handle_expt_event(self):
         # handle_expt_event() is called if there might be an error on the
         # socket, or if there is OOB data
@@ -605,16 +999,93 @@ class dispatcher:
 # [for more sophisticated usage use asynchat.async_chat]
 # ---------------------------------------------------------------------------
 
+class file_chunk:
+    """A region of an open file queued on a dispatcher_with_send.
+
+    The region is written with os.sendfile(), straight from the page cache,
+    and the file is closed once it has been sent (unless close is False).
+    """
+
+    __slots__ = ('file', 'offset', 'count', 'close_file')
+
+    def __init__(self, file, offset=0, count=None, close=True):
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.close_file = close
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.close_file:
+            self.file.close()
+
+
 class dispatcher_with_send(dispatcher):
+    # out_buffer is a queue of memoryviews and file_chunks. Consecutive
+    # memoryviews are flushed with a single sendmsg() call where possible,
+    # a partially sent chunk is advanced by slicing its memoryview, and
+    # file_chunks go through sendfile(), so nothing is ever copied.
+
+    __slots__ = ('out_buffer',)
+
+    # maximum number of chunks handed to one sendmsg() call
+    max_iov = 64
 
     def __init__(self, sock=None, map=None):
         dispatcher.__init__(self, sock, map)
-        self.out_buffer = b''
+        self.out_buffer = collections.deque()
 
     def initiate_send(self):
-        num_sent = 0
-        num_sent = dispatcher.send(self, self.out_buffer[:512])
-        self.out_buffer = self.out_buffer[num_sent:]
+        out = self.out_buffer
+        use_sendmsg = hasattr(self.socket, 'sendmsg')
+        while out:
+            head = out[0]
+            if isinstance(head, file_chunk):
+                self.write_blocked = False
+                num_sent = dispatcher.sendfile(self, head.file, head.offset,
+                                               head.count)
+                if not num_sent and not self.write_blocked:
+                    # end of file: it was truncated while being sent and
+                    # the response can't be completed
+                    if self.connected:
+                        self.handle_close()
+                    return
+                blocked = num_sent < head.count
+                head.offset += num_sent
+                head.count -= num_sent
+                if not head.count:
+                    out.popleft()
+                    head.close()
+                if blocked:
+                    return
+                continue
+            if use_sendmsg and len(out) > 1:
+                chunks = []
+                for chunk in itertools.islice(out, self.max_iov):
+                    if isinstance(chunk, file_chunk):
+                        break
+                    chunks.append(chunk)
+            else:
+                chunks = [head]
+            if len(chunks) > 1:
+                num_sent = dispatcher.sendmsg(self, chunks)
+            else:
+                num_sent = dispatcher.send(self, head)
+            blocked = num_sent < sum(len(chunk) for chunk in chunks)
+            while num_sent:
+                chunk = out[0]
+                if num_sent < len(chunk):
+                    out[0] = chunk[num_sent:]
+                    break
+                num_sent -= len(chunk)
+                out.popleft()
+            if blocked:
+                # the socket buffer is full, wait for the next write event
+                return
 
     def handle_write(self):
         self.initiate_send()
@@ -622,12 +1093,33 @@ class dispatcher_with_send(dispatcher):
     def writable(self):
         return (not self.connected) or len(self.out_buffer)
 
+    def push(self, data):
+        # queue data (bytes-like or a file_chunk) without sending it yet
+        if isinstance(data, file_chunk):
+            if data.count:
+                self.out_buffer.append(data)
+            else:
+                data.close()
+            return
+        if isinstance(data, bytearray):
+            # the caller may reuse its buffer
+            data = bytes(data)
+        if data:
+            self.out_buffer.append(memoryview(data))
+
     def send(self, data):
         if self.debug:
             self.log_info('sending %s' % repr(data))
-        self.out_buffer = self.out_buffer + data
+        self.push(data)
         self.initiate_send()
 
+    def close(self):
+        while self.out_buffer:
+            chunk = self.out_buffer.popleft()
+            if isinstance(chunk, file_chunk):
+                chunk.close()
+        dispatcher.close(self)
+
 
 # ---------------------------------------------------------------------------
 # used for debugging.
@@ -671,6 +1163,9 @@ def close_all(map=None, ignore_all=False):
             if not ignore_all:
                 raise
     map.clear()
+    pollster = _pollsters.pop(id(map), None)
+    if pollster is not None:
+        pollster.close()
 
 
 # Asynchronous File I/O:
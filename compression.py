@@ -0,0 +1,139 @@
+"""
+Content codings of static files.
+
+Files of compressible types are sent gzip or brotli encoded to clients that
+accept it. An up to date precompressed sidecar (style.css.gz, style.css.br)
+is used as is. Otherwise the cached body is compressed on a background
+thread and the variant stored in the file cache: the file is sent unencoded
+until its variant is ready, so the event loop never waits for the compressor.
+"""
+import gzip
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Codings in order of preference, brotli only if the module is installed
+COMPRESSORS = {'gzip': lambda data: gzip.compress(data, 6, mtime=0)}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda data: brotli.compress(data, quality=5)
+ENCODINGS = ('br', 'gzip')
+SIDECAR_SUFFIX = {'br': '.br', 'gzip': '.gz'}
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'application/xml', 'image/svg+xml')
+# Smaller bodies gain less than the Content-Encoding header costs
+MIN_SIZE = 256
+
+
+def compressible(content_type):
+    """
+    True if files of `content_type` are worth compressing, responses for
+    them vary with Accept-Encoding
+    """
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def accepted_encodings(value):
+    """
+    Codings of ENCODINGS accepted by an Accept-Encoding header value, in
+    order of preference. A coding with q=0 is refused, '*' stands for the
+    codings not listed.
+    """
+    if not value:
+        return []
+    qualities = {}
+    for item in value.lower().split(','):
+        coding, _, params = item.partition(';')
+        q = 1.0
+        name, _, param = params.partition('=')
+        if name.strip() == 'q':
+            try:
+                q = float(param)
+            except ValueError:
+                q = 0.0
+        qualities[coding.strip()] = q
+    star = qualities.get('*', 0.0)
+    return [coding for coding in ENCODINGS if qualities.get(coding, star) > 0]
+
+
+class Encoder:
+    """
+    Picks the representation of a file to send and compresses cached bodies
+    on a background thread
+    """
+
+    def __init__(self, cache, max_workers=1):
+        self.cache = cache
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        # Variants being compressed
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def select(self, entry, accept_encoding):
+        """
+        Return the entry to send for a file: a sidecar or an encoded variant
+        in a coding the client accepts, or the file itself
+        """
+        encodings = accepted_encodings(accept_encoding)
+        for encoding in encodings:
+            sidecar = self._sidecar(entry, encoding)
+            if sidecar is not None:
+                return sidecar
+        if entry.body is None or entry.size < MIN_SIZE:
+            return entry
+        for encoding in encodings:
+            if encoding not in COMPRESSORS:
+                continue
+            variant = self.cache.get_variant(entry, encoding)
+            if variant is None:
+                self._schedule(entry, encoding)
+            elif variant.body is not None:
+                return variant
+        return entry
+
+    def _sidecar(self, entry, encoding):
+        # A missing sidecar is remembered on the entry of the file, one added
+        # later is only picked up with the next version of the file or by new
+        # workers. A sidecar that was found is checked with a stat() on every
+        # use like any other file, it may have been replaced or removed.
+        if entry.sidecars.get(encoding) is False:
+            return None
+        sidecar = self.cache.lookup(entry.path + SIDECAR_SUFFIX[encoding], encoding)
+        if sidecar is not None and sidecar.mtime < entry.mtime:
+            # older than the file, out of date
+            sidecar = None
+        entry.sidecars[encoding] = sidecar is not None
+        return sidecar
+
+    def _schedule(self, entry, encoding):
+        name = entry.variant_name(encoding)
+        with self._lock:
+            if name in self._pending:
+                return
+            if self._pid != os.getpid():
+                # Threads don't survive fork(), pre-forked workers start their own
+                self._executor = ThreadPoolExecutor(self.max_workers,
+                                                    thread_name_prefix='compress')
+                self._pending.clear()
+                self._pid = os.getpid()
+            self._pending.add(name)
+            self._executor.submit(self._compress, entry, encoding, name)
+
+    def _compress(self, entry, encoding, name):
+        try:
+            # zlib and brotli release the GIL while compressing
+            body = COMPRESSORS[encoding](entry.body)
+            self.cache.put_variant(entry.variant(encoding, body))
+        except Exception:
+            logging.exception("Compressing {} with {} failed".format(entry.path, encoding))
+        finally:
+            with self._lock:
+                self._pending.discard(name)
@@ -0,0 +1,307 @@
+"""
+In-memory cache of static files shared by the request processors.
+
+Entries are kept in LRU order and bounded by the number of body bytes they
+hold. Every lookup costs a single stat() call: an entry is only used while
+the inode, size and modification time of the file still match, so edited
+or replaced files are picked up without any explicit invalidation.
+
+Optionally, files too large to cache but below max_mmap_size are mapped
+read-only instead. One mapping serves all the requests for the file and,
+being backed by the page cache, is shared with the other processes mapping
+it. Mappings have their own bound, max_mapped_bytes, as each one also holds
+a file descriptor. A dropped entry's mapping is closed, or once the last
+response using it is done.
+
+Encoded variants of cached bodies (see compression) share the same bound.
+They are keyed by path, file version and encoding, variants of an old
+version are never looked up again and age out in LRU order.
+"""
+import copy
+import mmap
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+
+# Total bytes of bodies and serialized responses kept in memory per cache
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Bodies of larger files are not cached, they are sent with sendfile()
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+# Larger files than max_file_size up to this size are mapped, 0 disables
+DEFAULT_MAX_MMAP_SIZE = 0
+# Total bytes of files mapped at a time per cache
+DEFAULT_MAX_MAPPED_BYTES = 256 * 1024 * 1024
+# Serialized responses kept per file (method, Host and Connection variants)
+MAX_RESPONSES = 4
+
+
+class CacheEntry:
+    """
+    Metadata of a regular file and, for small files, its body
+    """
+    __slots__ = ('path', 'name', 'key', 'size', 'mtime', 'etag', 'last_modified', 'body',
+                 'mapping', 'encoding', 'sidecars', 'header', 'responses')
+
+    def __init__(self, path, st, body=None, mapping=None, encoding=None):
+        self.path = path
+        # Key in the cache, the path for files
+        self.name = path
+        self.key = stat_key(st)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        # Validators for conditional requests, as header values
+        self.etag = make_etag(st)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True).encode('ascii')
+        self.body = body
+        # Read-only mmap of a file whose body isn't cached
+        self.mapping = mapping
+        # Content-Coding of the body, of encoded variants and precompressed
+        # files
+        self.encoding = encoding
+        # Whether a precompressed file was found for this version, by
+        # coding, see compression.Encoder
+        self.sidecars = {}
+        # Prebuilt status line and entity headers, filled in by the server
+        self.header = None
+        # Complete responses by request variant, see FileCache.put_response
+        self.responses = {}
+
+    def cost(self):
+        cost = len(self.body) if self.body is not None else 0
+        for response in self.responses.values():
+            cost += len(response.data)
+        return cost
+
+    def mapped_view(self):
+        """
+        Return a memoryview of the mapping, or None if the file isn't mapped
+        or the mapping has been released by the cache
+        """
+        if self.mapping is None:
+            return None
+        try:
+            return memoryview(self.mapping)
+        except ValueError:
+            return None
+
+    def release(self):
+        """
+        Close the mapping of an entry dropped from the cache, unless responses
+        still send from it: then it goes with the last of their views
+        """
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                pass
+
+    def variant_name(self, encoding):
+        """
+        Key of the variant encoded with `encoding` in the cache. It includes
+        the ETag, so that a variant made while it was weak isn't used for
+        the same file version with a strong one
+        """
+        return self.path, self.key, self.etag, encoding
+
+    def variant(self, encoding, body):
+        """
+        Return an entry for this file version encoded with `encoding`, or a
+        placeholder without body if encoding doesn't make it smaller
+        """
+        variant = copy.copy(self)
+        variant.name = self.variant_name(encoding)
+        variant.etag = self.etag[:-1] + b'-' + encoding.encode('ascii') + b'"'
+        variant.encoding = encoding
+        variant.mapping = None
+        variant.sidecars = {}
+        variant.header = None
+        variant.responses = {}
+        if body is None or len(body) >= self.size:
+            variant.body = None
+        else:
+            variant.size = len(body)
+            variant.body = body
+        return variant
+
+
+class CachedResponse:
+    """
+    A fully serialized response whose Date header sits at a known offset
+    """
+    __slots__ = ('data', 'date', 'date_offset')
+
+    def __init__(self, data, date):
+        self.data = data
+        self.date = date
+        self.date_offset = data.index(b'\r\nDate: ') + 8
+
+    def dated(self, date):
+        """
+        Return the response carrying `date`, only the Date slot is replaced
+        """
+        if date != self.date:
+            start = self.date_offset
+            self.data = self.data[:start] + date + self.data[start + len(self.date):]
+            self.date = date
+        return self.data
+
+
+class FileCache:
+    """
+    Bounded LRU cache of files keyed by path
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_file_size=DEFAULT_MAX_FILE_SIZE,
+                 max_mmap_size=DEFAULT_MAX_MMAP_SIZE, max_mapped_bytes=DEFAULT_MAX_MAPPED_BYTES):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.max_mmap_size = max_mmap_size
+        self.max_mapped_bytes = max_mapped_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._mapped = 0
+        self._entries = OrderedDict()
+        # The threaded server looks files up from its worker threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<FileCache entries={} bytes={} hits={} misses={} evictions={}>'.format(
+            len(self._entries), self._bytes, self.hits, self.misses, self.evictions)
+
+    def lookup(self, path, encoding=None):
+        """
+        Return the entry of a regular file or None if there is no such file.
+        `encoding` is the Content-Coding of a precompressed file.
+        """
+        try:
+            st = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+            # An entry made just after the file was modified has a weak ETag,
+            # it is reloaded for a strong one once the file has settled
+            if entry is not None and entry.key == stat_key(st) and \
+                    entry.encoding == encoding and \
+                    not (entry.etag.startswith(b'W/') and time.time() - st.st_mtime >= 1):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        try:
+            entry = self._load(path, encoding)
+        except OSError:
+            return None
+        self._store(entry)
+        return entry
+
+    def _load(self, path, encoding=None):
+        with open(path, 'rb') as f:
+            # The key comes from the opened file so that it matches the body
+            st = os.fstat(f.fileno())
+            if st.st_size <= self.max_file_size:
+                return CacheEntry(path, st, f.read(), encoding=encoding)
+            if st.st_size <= min(self.max_mmap_size, self.max_mapped_bytes):
+                # The mapping outlives the file object
+                return CacheEntry(path, st, mapping=mmap.mmap(f.fileno(), 0,
+                                                              access=mmap.ACCESS_READ),
+                                  encoding=encoding)
+        return CacheEntry(path, st, encoding=encoding)
+
+    def get_variant(self, entry, encoding):
+        """
+        Return the variant of `entry` encoded with `encoding`, see
+        CacheEntry.variant, or None if it hasn't been stored
+        """
+        name = entry.variant_name(encoding)
+        with self._lock:
+            variant = self._entries.get(name)
+            if variant is not None:
+                self._entries.move_to_end(name)
+            return variant
+
+    def put_variant(self, variant):
+        self._store(variant)
+
+    def _store(self, entry):
+        with self._lock:
+            old = self._entries.pop(entry.name, None)
+            if old is not None:
+                self._drop(old)
+            self._entries[entry.name] = entry
+            self._bytes += entry.cost()
+            if entry.mapping is not None:
+                self._mapped += entry.size
+            self._evict()
+
+    def get_response(self, entry, key, date):
+        """
+        Return the serialized response for a request variant of a cached
+        file, re-dated if needed, or None
+        """
+        response = entry.responses.get(key)
+        if response is None:
+            return None
+        with self._lock:
+            return response.dated(date)
+
+    def put_response(self, entry, key, data, date):
+        """
+        Remember the serialized response of a request variant of `entry`
+        """
+        with self._lock:
+            if self._entries.get(entry.name) is not entry or \
+                    len(entry.responses) >= MAX_RESPONSES:
+                return
+            entry.responses[key] = CachedResponse(data, date)
+            self._bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes or self._mapped > self.max_mapped_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._drop(evicted)
+            self.evictions += 1
+
+    def _drop(self, entry):
+        self._bytes -= entry.cost()
+        if entry.mapping is not None:
+            self._mapped -= entry.size
+            entry.release()
+
+    def stats(self):
+        return {'entries': len(self._entries),
+                'bytes': self._bytes,
+                'mapped': self._mapped,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+def stat_key(st):
+    """
+    Identity of a file version: inode, size and modification time
+    """
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def make_etag(st):
+    """
+    Entity tag of a file version built from its stat data. It is weak if
+    the file was modified within the last second, as it may be modified
+    again without its modification time changing.
+    """
+    etag = b'"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+    if time.time() - st.st_mtime < 1:
+        return b'W/' + etag
+    return etag
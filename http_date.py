@@ -0,0 +1,38 @@
+"""
+Value of the Date response header.
+
+Formatting the date for every response is wasted work, it only changes
+once per second. The event loop calls refresh() at the start of every
+second and responses take the preencoded RFC 7231 IMF-fixdate from get(),
+e.g. b'Sun, 06 Nov 1994 08:49:37 GMT'.
+"""
+import time
+from email.utils import formatdate
+
+_second = None
+_date = None
+
+
+def refresh():
+    """
+    Regenerate the date if the second has changed, returns the seconds
+    left until the next one
+    """
+    global _second, _date
+    now = time.time()
+    second = int(now)
+    if second != _second:
+        # formatdate() doesn't depend on the locale, unlike strftime()
+        _date = formatdate(second, usegmt=True).encode('ascii')
+        _second = second
+    return 1 - (now - second)
+
+
+def get():
+    """
+    Return the current date as bytes
+    """
+    return _date
+
+
+refresh()
@@ -0,0 +1,180 @@
+"""
+Incremental HTTP/1.x request parser.
+
+Data is fed as it arrives from the socket and complete requests are taken
+off the front of the buffer. The end of the header block is searched for
+only in newly received bytes, and the request line and headers are split
+in a single pass over that block. Size limits are enforced while parsing,
+so an oversized request is rejected before it is buffered in full.
+"""
+
+MAX_LINE = 64 * 1024
+MAX_HEADERS = 100
+# Request bodies are read and discarded, the server only serves GET/HEAD
+MAX_BODY = 1024 * 1024
+
+
+class ParseError(Exception):
+    """
+    Malformed or oversized request, the connection can't be reused
+    """
+
+    def __init__(self, status, reason, body=None):
+        super().__init__(status, reason)
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class Headers(dict):
+    """
+    Header mapping with case-insensitive names
+    """
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+class Request:
+    """
+    A parsed request
+    """
+    __slots__ = ('method', 'target', 'version', 'headers', 'body')
+
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return '<Request {} {} {}>'.format(self.method, self.target, self.version)
+
+
+class RequestParser:
+    """
+    Splits a byte stream into requests, see feed() and next_request()
+    """
+
+    def __init__(self, max_line=MAX_LINE, max_headers=MAX_HEADERS, max_body=MAX_BODY):
+        self.max_line = max_line
+        self.max_headers = max_headers
+        self.max_body = max_body
+        self.buffer = bytearray()
+        # Offset from which to look for the end of the header block
+        self._scan = 0
+        # Request waiting for its body and the body length
+        self._request = None
+        self._body_length = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def reset(self):
+        self.buffer.clear()
+        self._scan = 0
+        self._request = None
+
+    def pending(self):
+        """
+        True if a request has been started but not completed
+        """
+        return bool(self.buffer) or self._request is not None
+
+    def reading_body(self):
+        """
+        True if the head of a request has been parsed and its body not
+        """
+        return self._request is not None
+
+    def next_request(self):
+        """
+        Return the next complete request or None if more data is needed
+        """
+        buf = self.buffer
+        request = self._request
+        if request is None:
+            # Empty lines before a request line are ignored (RFC 7230 3.5)
+            while buf[:2] == b'\r\n':
+                del buf[:2]
+            end = buf.find(b'\r\n\r\n', self._scan)
+            if end < 0:
+                self._check_partial()
+                self._scan = max(0, len(buf) - 3)
+                return None
+            request = self._parse_head(bytes(buf[:end]))
+            # Deleting from the front of a bytearray doesn't move the rest
+            del buf[:end + 4]
+            self._scan = 0
+            if not self._body_length:
+                return request
+            self._request = request
+        if len(buf) < self._body_length:
+            return None
+        request.body = bytes(buf[:self._body_length])
+        del buf[:self._body_length]
+        self._request = None
+        self._body_length = 0
+        return request
+
+    def _check_partial(self):
+        buf = self.buffer
+        line_end = buf.find(b'\r\n', 0, self.max_line + 2)
+        if line_end < 0:
+            if len(buf) > self.max_line:
+                raise ParseError(414, 'Request-URI Too Long')
+        elif len(buf) > self.max_line * 2:
+            raise ParseError(431, 'Request Header Fields Too Large')
+
+    def _parse_head(self, head):
+        lines = head.split(b'\r\n')
+        if len(lines[0]) > self.max_line:
+            raise ParseError(414, 'Request-URI Too Long')
+        # the same bound as _check_partial(), whether or not the head came
+        # in one piece
+        if len(head) > self.max_line * 2:
+            raise ParseError(431, 'Request Header Fields Too Large')
+        if len(lines) - 1 > self.max_headers:
+            raise ParseError(431, 'Request Header Fields Too Large', 'Too many headers')
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith(b'HTTP/'):
+            raise ParseError(400, 'Bad request', 'Malformed request line')
+        method, target, version = [part.decode('latin-1') for part in parts]
+        headers = Headers()
+        for line in lines[1:]:
+            if len(line) > self.max_line:
+                raise ParseError(431, 'Request Header Fields Too Large')
+            name, sep, value = line.partition(b':')
+            if not sep or not name or name[-1:].isspace():
+                raise ParseError(400, 'Bad request', 'Malformed header line')
+            name = name.decode('latin-1').lower()
+            value = value.strip().decode('latin-1')
+            if name in headers:
+                value = dict.__getitem__(headers, name) + ', ' + value
+            dict.__setitem__(headers, name, value)
+        self._body_length = self._content_length(headers)
+        return Request(method, target, version, headers)
+
+    def _content_length(self, headers):
+        if 'transfer-encoding' in headers:
+            raise ParseError(501, 'Not Implemented', 'Transfer-Encoding')
+        length = headers.get('content-length')
+        if length is None:
+            return 0
+        # isdigit() alone takes other scripts' digits, int() doesn't
+        if not (length.isascii() and length.isdigit()):
+            raise ParseError(400, 'Bad request', 'Malformed Content-Length')
+        try:
+            length = int(length)
+        except ValueError:
+            raise ParseError(400, 'Bad request', 'Malformed Content-Length')
+        if length > self.max_body:
+            raise ParseError(413, 'Request Entity Too Large')
+        return length
@@ -6,18 +6,24 @@ import select
 import sys
 import threading
 import time
+from collections import Counter, deque
 from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime
-from email.parser import Parser
+from functools import partial
+from email.utils import parsedate_to_datetime
 from optparse import OptionParser
+from errno import EMFILE, ENFILE, ENOBUFS, ENOMEM
 from socket import socket, error, \
     AF_INET, SOCK_STREAM, \
     SOL_SOCKET, SO_REUSEADDR
 from sys import platform
 from urllib.parse import unquote
 
-# MAX_LINE = 64 * 1024
-# MAX_HEADERS = 100
+import asyncore_epoll
+import compression
+import http_date
+from file_cache import FileCache
+from http_parser import RequestParser, ParseError
+
 # Default error message template
 DEFAULT_ERROR_MESSAGE = """\
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
@@ -38,12 +44,30 @@ DEFAULT_ERROR_MESSAGE = """\
 
 # DEFAULT_ERROR_CONTENT_TYPE = "text/html;charset=utf-8"
 
-HEADER = """\
+# Status line and entity headers come first, so that they can be prebuilt
+# once per cached file
+STATUS_HEADER = """\
 HTTP/1.1 {code} {explain}\r
-Date: {date}\r
-Server: {servername}\r
 Content-Length: {length}\r
 Content-Type: {type}\r
+"""
+
+# Validators of a file, sent with it and with 304 responses
+VALIDATOR_HEADER = b"ETag: %s\r\nLast-Modified: %s\r\n"
+
+# Representations of compressible files, see compression
+CONTENT_ENCODING_HEADER = b"Content-Encoding: %s\r\n"
+VARY_HEADER = b"Vary: Accept-Encoding\r\n"
+
+# Files are sent whole or by byte ranges, see http_ranges()
+ACCEPT_RANGES_HEADER = b"Accept-Ranges: bytes\r\n"
+CONTENT_RANGE_HEADER = b"Content-Range: bytes %d-%d/%d\r\n"
+# A request for more ranges than this gets the whole file
+MAX_RANGES = 16
+
+# The Date header is added as preencoded bytes, see http_date
+GENERAL_HEADER = """\
+Server: {servername}\r
 Connection: {conn}\r
 """
 
@@ -62,7 +86,24 @@ DEFAULT_TIMEOUT = 0
 
 DEFAULT_BUFFSIZE = 1024
 
-DATE = datetime.now().strftime("%a %d %b %Y, %H:%M:%S GMT")
+# Slow clients: seconds allowed for the head and the body of a request, and
+# without progress while sending a response
+HEADER_TIMEOUT = 10
+BODY_TIMEOUT = 30
+WRITE_TIMEOUT = 30
+
+# Overload: open connections, expected wait in the worker queue above which
+# requests are answered with 503 (0 disables), and how long accepting
+# pauses when the process runs out of file descriptors
+MAX_CONNECTIONS = 1024
+LATENCY_BUDGET = 0
+ACCEPT_RETRY = 0.5
+
+FILE_CACHE = FileCache()
+ENCODER = compression.Encoder(FILE_CACHE)
+
+# Returned by PollQueue._read_request() when the client has closed
+CLOSED = object()
 
 
 class MyHTTPServer:
@@ -91,47 +132,273 @@ class PollQueue:
     def __init__(self, httpd_server, processor, thr_count=2, timeout=DEFAULT_TIMEOUT):
         self._document_root = ''
         self._buffsize = DEFAULT_BUFFSIZE
+        # Only the event loop thread reads, into this buffer
+        self._recv_view = memoryview(bytearray(self._buffsize))
         self._response_body = DEFAULT_ERROR_MESSAGE
         self._timeout = timeout
         self._processor = processor
         self._httpd_server = httpd_server
         self._thr_count = thr_count
+        # One pool for the lifetime of the server, requests are handed to it
+        # by the event loop
+        self._executor = ThreadPoolExecutor(max_workers=thr_count)
+        # Finished requests, the workers wake the event loop up through a pipe
+        self._done = deque()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self.header_timeout = HEADER_TIMEOUT
+        self.body_timeout = BODY_TIMEOUT
+        self.write_timeout = WRITE_TIMEOUT
+        # Connections closed by each timeout
+        self.timeouts = Counter()
+        self.max_connections = MAX_CONNECTIONS
+        self.latency_budget = LATENCY_BUDGET
+        self.rejected = 0
+        # Requests handed to the workers and not answered yet, and the
+        # average time a worker takes for one. Both belong to the event
+        # loop thread, the workers only report their time with the response.
+        self._pending = 0
+        self._service_time = 0.0
+
+    def _notify(self, fd, worker, future):
+        # Runs on the worker thread once the request has been processed
+        self._done.append((fd, worker, future))
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the event loop is going to wake up anyway
+            pass
+
+    def _process(self, worker, request):
+        # Runs on the worker thread, the time is read by the event loop
+        # once the future is done
+        start = time.monotonic()
+        try:
+            return worker.process(request)
+        finally:
+            worker.service_time = time.monotonic() - start
+
+    def _overloaded(self):
+        # Time a new request would wait for a worker
+        wait = self._pending * self._service_time / self._thr_count
+        return self.latency_budget and wait > self.latency_budget
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _read_request(self, client, parser):
+        """
+        Take whatever the client has sent without blocking. Returns a
+        complete request, a ParseError to answer, CLOSED if the client has
+        gone away, or None while the request is incomplete.
+        """
+        view = self._recv_view
+        while True:
+            try:
+                nbytes = client.recv_into(view)
+            except BlockingIOError:
+                break
+            except error as e:
+                logging.error(e)
+                return CLOSED
+            if not nbytes:
+                return CLOSED
+            parser.feed(view[:nbytes])
+            if nbytes < len(view):
+                break
+        try:
+            return parser.next_request()
+        except ParseError as e:
+            return e
 
     def epoll_serve_forever(self, response=None):
         # Create an epoll objects
         epl = select.epoll()
         # Corresponding to the listening socket fd (file descriptor) registered to the epoll
         epl.register(self._httpd_server.fileno(), select.EPOLLIN)
+        epl.register(self._wakeup_r, select.EPOLLIN)
         logging.info("FD {fd} registred in epoll".format(fd=self._httpd_server.fileno()))
         try:
             # Correspondence between storage and file descriptor fd socket
             fd_event_dict = {}
+            # Requests being received, one incremental parser per socket
             requests = {}
-            responses = {}
+            # Responses being sent to slow clients
+            writers = {}
+            # The timer closing each of those connections if its client is
+            # too slow, and why
+            timers = {}
+            # Whether the listening socket is polled, and the descriptor
+            # shortage pausing it
+            listening = [True]
+            accept_paused = [False]
+
+            def update_listener():
+                # Stop polling the listening socket at the connection limit,
+                # new connections wait in the backlog
+                listen = len(fd_event_dict) < self.max_connections and not accept_paused[0]
+                if listen != listening[0]:
+                    epl.modify(self._httpd_server.fileno(), select.EPOLLIN if listen else 0)
+                    listening[0] = listen
+
+            def resume_accept():
+                accept_paused[0] = False
+
+            def start_response(fd, worker, finished):
+                if finished:
+                    del fd_event_dict[fd]
+                else:
+                    # The socket is full, the rest is sent on EPOLLOUT
+                    epl.register(fd, select.EPOLLOUT)
+                    writers[fd] = worker
+                    set_timeout(fd, self.write_timeout, 'write')
+
+            def set_timeout(fd, delay, reason):
+                old = timers.get(fd)
+                if old is not None:
+                    old.cancel()
+                timers[fd] = asyncore_epoll.call_later(delay, expire, fd, reason)
+
+            def clear_timeout(fd):
+                old = timers.pop(fd, None)
+                if old is not None:
+                    old.cancel()
+
+            def expire(fd, reason):
+                del timers[fd]
+                self.timeouts[reason] += 1
+                logging.info("{reason} timeout on fd {fd}, {count} so far".format(
+                    reason=reason, fd=fd, count=self.timeouts[reason]))
+                epl.unregister(fd)
+                requests.pop(fd, None)
+                worker = writers.pop(fd, None)
+                client = fd_event_dict.pop(fd)
+                if worker is not None:
+                    worker.close()
+                else:
+                    client.close()
+
+            def fail(fd):
+                # An unexpected error while serving a client only closes its
+                # connection, with a 500 if no response has been started
+                logging.exception("Error serving fd {}".format(fd))
+                clear_timeout(fd)
+                try:
+                    epl.unregister(fd)
+                except OSError:
+                    pass
+                parser = requests.pop(fd, None)
+                worker = writers.pop(fd, None)
+                client = fd_event_dict.pop(fd, None)
+                if parser is not None and client is not None:
+                    try:
+                        client.send(HTTPError(500, 'Internal Server Error', 'Server error',
+                                              servername='Error').error_content())
+                    except OSError:
+                        pass
+                if worker is not None:
+                    worker.close()
+                elif client is not None:
+                    client.close()
+
+            def serve(fd, event):
+                if fd in writers:
+                    if not (event & (select.EPOLLERR | select.EPOLLHUP) or
+                            writers[fd].send_some()):
+                        # Restarted whenever the client takes part of the response
+                        set_timeout(fd, self.write_timeout, 'write')
+                        return
+                    clear_timeout(fd)
+                    epl.unregister(fd)
+                    writers.pop(fd).close()
+                    del fd_event_dict[fd]
+                elif fd in requests:
+                    client = fd_event_dict[fd]
+                    parser = requests[fd]
+                    request = self._read_request(client, parser)
+                    if request is None:
+                        # Wait for the rest of the request, the head and
+                        # the body each have to arrive within their timeout
+                        if parser.reading_body() and timers[fd].args[1] != 'body':
+                            set_timeout(fd, self.body_timeout, 'body')
+                        return
+                    clear_timeout(fd)
+                    epl.unregister(fd)
+                    del requests[fd]
+                    if request is CLOSED:
+                        del fd_event_dict[fd]
+                        client.close()
+                        return
+                    worker = ThreadingEcho(client, self._processor)
+                    if self._overloaded():
+                        # Answer right away rather than let the request
+                        # wait longer than the latency budget
+                        self.rejected += 1
+                        response = HTTPError(503, 'Service Unavailable', 'Server overloaded',
+                                             servername='Error').error_content()
+                        start_response(fd, worker, worker.start_response([response]))
+                        return
+                    # Only complete requests go to the workers
+                    self._pending += 1
+                    future = self._executor.submit(self._process, worker, request)
+                    future.add_done_callback(partial(self._notify, fd, worker))
+
+            refresh_date()
             while True:
                 # Default clog, known os detected data arrives, tell the program through
                 # an event notification method, this time will de-clog
-                fd_event_list = epl.poll()
+                fd_event_list = epl.poll(asyncore_epoll.timer_timeout(None))
                 for fd, event in fd_event_list:
                     # If the data over the listening socket, that is waiting for new client connections
                     if fd == self._httpd_server.fileno():
-                        client, info = self._httpd_server.accept()
+                        try:
+                            client, info = self._httpd_server.accept()
+                        except BlockingIOError:
+                            continue
+                        except error as e:
+                            if e.errno not in (EMFILE, ENFILE, ENOBUFS, ENOMEM):
+                                raise
+                            # Out of descriptors or memory: the connection
+                            # stays in the backlog until some are released
+                            logging.error("accept: {}, pausing for {}s".format(e, ACCEPT_RETRY))
+                            accept_paused[0] = True
+                            asyncore_epoll.call_later(ACCEPT_RETRY, resume_accept)
+                            continue
                         client.setblocking(False)
                         # The new socket is registered in epoll
                         epl.register(client.fileno(), select.EPOLLIN)
                         # The correspondence between file descriptors and sockets into dictionary
                         fd_event_dict[client.fileno()] = client
-                        requests[client.fileno()] = b''
-                        responses[client.fileno()] = response
-                    elif event == select.EPOLLIN:
-                        # Judge whether a socket connected data sent me
-                        with ThreadPoolExecutor(max_workers=self._thr_count) as executor:
-                            worker = ThreadingEcho(fd_event_dict[fd], self._processor)
-                            executor.submit(worker.handle_connection())
+                        requests[client.fileno()] = RequestParser()
+                        set_timeout(client.fileno(), self.header_timeout, 'header')
+                    elif fd == self._wakeup_r:
+                        # Workers have finished requests, send the responses
+                        self._drain_wakeup()
+                        while self._done:
+                            client_fd, worker, future = self._done.popleft()
+                            self._pending -= 1
+                            self._service_time += (worker.service_time - self._service_time) / 8
+                            try:
+                                start_response(client_fd, worker, worker.finish_request(future))
+                            except Exception:
+                                fail(client_fd)
+                    else:
+                        try:
+                            serve(fd, event)
+                        except Exception:
+                            fail(fd)
+                asyncore_epoll.run_timers()
+                update_listener()
         finally:
             epl.unregister(self._httpd_server.fileno())
             epl.close()
             self._httpd_server.close()
+            self._executor.shutdown(wait=False)
 
     def kqueue_server_forever(self):
         try:
@@ -140,6 +407,7 @@ class PollQueue:
                                           filter=select.KQ_FILTER_READ,
                                           flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT)
             while True:
+                http_date.refresh()
                 registered_events = kq.control([change_kevent], 1, self._timeout)
                 for event in registered_events:
                     if event.filter == select.KQ_EV_EOF:
@@ -147,18 +415,25 @@ class PollQueue:
                         kq.control([new_event], 0, 0)
                     else:
                         cl, _ = self._httpd_server.accept()
-                        with ThreadPoolExecutor(max_workers=self._thr_count) as executor:
-                            worker = ThreadingEcho(cl, self._processor)
-                            executor.submit(worker.handle_connection())
+                        worker = ThreadingEcho(cl, self._processor)
+                        self._executor.submit(worker.handle_connection)
         finally:
             kq.close()
             self._httpd_server.close()
+            self._executor.shutdown(wait=False)
+
+
+def refresh_date():
+    # Regenerate the Date header at the start of every second
+    asyncore_epoll.call_later(http_date.refresh(), refresh_date)
 
 
 class ThreadingEcho:
     def __init__(self, client, processor):
         self.client = client
         self._processor = processor
+        # Seconds spent in process(), see PollQueue._process
+        self.service_time = 0.0
 
     def handle_connection(self):
         """
@@ -167,94 +442,419 @@ class ThreadingEcho:
                 available on the read side, shutdown and close the
                 socket.
             """
-        buf = b''
         try:
-            while True:
-                recv = self.client.recv(DEFAULT_BUFFSIZE)
-                buf += recv
-                if buf.endswith(b'\r\n') or buf.endswith(b'\n'):
-                    break
-            message = self._processor(buf)
-            self.send_all(message)
+            message = self.handle_request()
+            if message is not None:
+                self.send_all(message)
             self.client.close()
-            if isinstance(self.client, dict):
-                del self.client
         except error as e:
-            if error.errno == 35:
-                logging.error(e)
-                return True
-            elif error.errno == 57:
-                logging.error(e)
-                return True
-            else:
-                logging.error(e)
-                pass
+            logging.error(e)
+            self.client.close()
 
-    def send_all(self, message, timeout=DEFAULT_TIMEOUT):
-        # Sender byte by byte
-        content_length = len(message)
-        bt = self.client.send(message)
-        time.sleep(timeout)
-        while bt < content_length:
-            bt += self.client.send(message[bt:])
+    def handle_request(self):
+        """
+        Read the request and process it, returns the response or None if
+        the client has gone away
+        """
+        parser = RequestParser()
+        view = memoryview(bytearray(DEFAULT_BUFFSIZE))
+        while True:
+            try:
+                nbytes = self.client.recv_into(view)
+            except BlockingIOError:
+                if not select.select([self.client], [], [], HEADER_TIMEOUT)[0]:
+                    raise TimeoutError("header timeout")
+                continue
+            if not nbytes:
+                return None
+            parser.feed(view[:nbytes])
+            try:
+                request = parser.next_request()
+            except ParseError as e:
+                return [http_error_gen(e)]
+            if request is not None:
+                return self._processor(request)
+
+    def process(self, request):
+        """
+        Process a request received by the event loop. Called on a worker
+        thread.
+        """
+        if isinstance(request, ParseError):
+            return [http_error_gen(request)]
+        return self._processor(request)
+
+    def finish_request(self, future):
+        """
+        Start sending the response of process() without blocking. Returns
+        True if the connection is finished, False if the rest of the
+        response has to wait for send_some(). Called on the event loop
+        thread.
+        """
+        try:
+            message = future.result()
+        except Exception:
+            logging.exception("Request failed")
+            message = None
+        return self.start_response(message)
+
+    def start_response(self, message):
+        """
+        Start sending the response parts in `message`, see finish_request()
+        """
+        if message is None:
+            self.close()
+            return True
+        # [part, offset, end] for every part still to be sent
+        self._out = deque([part, part.offset, part.offset + part.count]
+                          if isinstance(part, asyncore_epoll.file_chunk)
+                          else [part, 0, len(part)]
+                          for part in message)
+        if not self.send_some():
+            return False
+        self.close()
+        return True
+
+    def send_some(self):
+        """
+        Send as much of the response as the socket takes, resuming where
+        the previous call stopped. Returns True once the connection is
+        done with: everything is sent or the client has gone away.
+        """
+        out = self._out
+        try:
+            while out:
+                part, offset, end = out[0]
+                if isinstance(part, asyncore_epoll.file_chunk):
+                    sent = os.sendfile(self.client.fileno(), part.file.fileno(),
+                                       offset, end - offset)
+                    if not sent:
+                        # the file was truncated while being sent
+                        break
+                else:
+                    sent = self.client.send(memoryview(part)[offset:end])
+                out[0][1] = offset = offset + sent
+                if offset == end:
+                    out.popleft()
+                    if isinstance(part, asyncore_epoll.file_chunk):
+                        part.close()
+        except BlockingIOError:
+            return False
+        except error as e:
+            logging.error(e)
+        return True
 
+    def close(self):
+        for part, _, _ in getattr(self, '_out', ()):
+            if isinstance(part, asyncore_epoll.file_chunk):
+                part.close()
+        self._out = deque()
+        self.client.close()
 
-def http_processor(request, date=DATE, document_root=''):
-    # Accept the browser sent me the http request
+    def send_all(self, message, timeout=DEFAULT_TIMEOUT):
+        # Send every part of the response, files go through sendfile()
+        time.sleep(timeout)
+        try:
+            for part in message:
+                if isinstance(part, asyncore_epoll.file_chunk):
+                    self._send_file(part)
+                else:
+                    self._send_bytes(part)
+        finally:
+            for part in message:
+                if isinstance(part, asyncore_epoll.file_chunk):
+                    part.close()
+
+    def _send_bytes(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[self.client.send(view):]
+            except BlockingIOError:
+                self._wait_writable()
+
+    def _send_file(self, chunk):
+        offset = chunk.offset
+        end = offset + chunk.count
+        while offset < end:
+            try:
+                sent = os.sendfile(self.client.fileno(), chunk.file.fileno(),
+                                   offset, end - offset)
+            except BlockingIOError:
+                self._wait_writable()
+                continue
+            if not sent:
+                # the file was truncated while being sent, the client sees
+                # a short body when the connection is closed
+                break
+            offset += sent
+
+    def _wait_writable(self):
+        if not select.select([], [self.client], [], WRITE_TIMEOUT)[1]:
+            raise TimeoutError("write timeout")
+
+
+def http_processor(request, date=None, document_root=''):
+    # Answer a parsed request
+    if date is None:
+        date = http_date.get()
     try:
-        request_str = request.decode('utf-8')
-        req, header_alone = http_req_line_parser(request_str)
-        req_header = http_parse_header(header_alone)
-        method, target, ver = http_parse_request_line(req)
+        method, target, ver = request.method.lower(), request.target, request.version
+        req_header = request.headers
         file_name = http_parse_file_name(unquote(target))
         path = "./" + document_root + "/" + file_name
         ext = get_filename_ext(path)
-        http_status_error_response(method, target, ver, path, ext)
+        http_status_error_response(method, target, ver, ext)
+        entry = FILE_CACHE.lookup(path)
+        if entry is None:
+            raise HTTPError(404, 'Not Found')
         content_type = http_content_type(ext)
-        header = http_header_gen(path, req_header, content_type)
+        if compression.compressible(content_type):
+            entry = ENCODER.select(entry, req_header.get("Accept-Encoding"))
+        if http_not_modified(entry, req_header):
+            return [http_not_modified_gen(entry, req_header, content_type, date)]
+        ranges = http_ranges(entry, req_header) if method == 'get' else None
+        if ranges is not None:
+            return http_partial_gen(entry, req_header, content_type, ranges, date)
+        if entry.body is not None:
+            return [http_cached_response(entry, method, req_header, content_type, date)]
+        header = http_header_gen(entry, req_header, content_type, date)
         if method == 'head':
-            return header + b'\r\n'
-        body = http_body_gen(path, content_type)
-        return header + b'\r\n' + body + b'\r\n'
+            return [header + b'\r\n']
+        body = http_body_gen(entry, content_type)
+        return [header + b'\r\n', body]
     except Exception as e:
-        if hasattr(e, 'status'):
-            err = HTTPError(e.status, e.reason, e.body, date, 'Error')
-            logging.error("ERROR Occured status - {}, reason - {}, date - {}, host - {}".format(e.status,
-                                                                                                e.reason,
-                                                                                                date,
-                                                                                                'Error'))
-        else:
-            err = HTTPError('405', 'Method Not Implemented', 'Request Error', date)
-            logging.error(
-                "ERROR Occured status - 405, reason - Method Not Implemented, date - {}".format(date))
-        return err.error_content()
+        return [http_error_gen(e, date)]
 
 
-def http_body_gen(path, content_type):
+def http_error_gen(e, date=None):
     """
-    Returns body of opened file
+    Generate the error response for an exception raised by the processor
     """
-    if 'image' or 'application' in content_type:
-        with open(path, "rb") as f:
-            body = f.read()
+    if date is None:
+        date = http_date.get()
+    if hasattr(e, 'status'):
+        err = HTTPError(e.status, e.reason, e.body, date, 'Error')
+        logging.error("ERROR Occured status - {}, reason - {}, date - {}, host - {}".format(e.status,
+                                                                                            e.reason,
+                                                                                            date.decode(),
+                                                                                            'Error'))
     else:
-        with open(path, "r") as f:
-            body = f.read().encode("utf-8")
-    return body
+        err = HTTPError('405', 'Method Not Implemented', 'Request Error', date)
+        logging.error(
+            "ERROR Occured status - 405, reason - Method Not Implemented, date - {}".format(date.decode()))
+    return err.error_content()
+
+
+def http_body_gen(entry, content_type):
+    """
+    Returns cached body of the file, a view of its mapping, or the opened
+    file to be sent with sendfile()
+    """
+    if entry.body is not None:
+        return entry.body
+    view = entry.mapped_view()
+    if view is not None:
+        return view
+    # Content-Length is entry.size: no more is sent if the file has grown,
+    # and the connection is closed if it has been truncated
+    return asyncore_epoll.file_chunk(open(entry.path, "rb"), count=entry.size)
+
+
+def http_header_gen(entry, header, content_type, date=None, conn='Close'):
+    """
+    Generate and return header, the status line and entity headers are
+    built once per cache entry
+    """
+    if entry.header is None:
+        entry.header = STATUS_HEADER.format(code='200',
+                                            explain='OK',
+                                            length=entry.size,
+                                            type=content_type).encode("utf-8") + \
+            http_entity_header(entry, content_type) + ACCEPT_RANGES_HEADER
+    if date is None:
+        date = http_date.get()
+    return entry.header + b'Date: ' + date + b'\r\n' + \
+        GENERAL_HEADER.format(servername=header.get("Host"), conn=conn).encode("utf-8")
+
+
+def http_not_modified(entry, header):
+    """
+    True if the client's copy of the file is current. If-None-Match is
+    compared weakly with the ETag, If-Modified-Since only counts without it
+    """
+    if_none_match = header.get("If-None-Match")
+    if if_none_match is not None:
+        etag = entry.etag[2:] if entry.etag.startswith(b'W/') else entry.etag
+        for tag in if_none_match.split(','):
+            tag = tag.strip().encode("latin-1")
+            if tag == b'*' or tag == etag or tag == b'W/' + etag:
+                return True
+        return False
+    if_modified_since = header.get("If-Modified-Since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # a date in the future is invalid
+    return int(entry.mtime) <= since <= time.time()
 
 
-def http_header_gen(path, header, content_type, date=DATE):
+def http_entity_header(entry, content_type):
     """
-    Generate and return header
+    Validators and coding of the representation of a file that is sent
+    """
+    entity = VALIDATOR_HEADER % (entry.etag, entry.last_modified)
+    if entry.encoding is not None:
+        entity += CONTENT_ENCODING_HEADER % entry.encoding.encode("ascii")
+    if compression.compressible(content_type):
+        entity += VARY_HEADER
+    return entity
+
+
+def http_not_modified_gen(entry, header, content_type, date=None, conn='Close'):
     """
-    header = HEADER.format(code='200',
-                           explain='OK',
-                           date=date,
-                           servername=header.get("Host"),
-                           length=os.path.getsize(path),
-                           type=content_type,
-                           conn='Close').encode("utf-8")
-    return header
+    Generate a 304 response, it carries the validators but no body
+    """
+    if date is None:
+        date = http_date.get()
+    vary = VARY_HEADER if compression.compressible(content_type) else b''
+    return b'HTTP/1.1 304 Not Modified\r\n' + \
+        VALIDATOR_HEADER % (entry.etag, entry.last_modified) + vary + \
+        b'Date: ' + date + b'\r\n' + \
+        GENERAL_HEADER.format(servername=header.get("Host"), conn=conn).encode("utf-8") + b'\r\n'
+
+
+def http_ranges(entry, header):
+    """
+    Byte ranges of the file asked for with the Range header, as (offset,
+    count) pairs. None means the whole file is sent: there is no usable
+    Range header or If-Range doesn't match the file. An empty list means
+    that none of the ranges can be satisfied.
+    """
+    value = header.get("Range")
+    if value is None:
+        return None
+    if_range = header.get("If-Range")
+    if if_range is not None and not http_if_range(entry, if_range):
+        return None
+    unit, sep, specs = value.partition('=')
+    specs = specs.split(',')
+    if not sep or unit.strip().lower() != 'bytes' or len(specs) > MAX_RANGES:
+        return None
+    size = entry.size
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        digits = first + last
+        # isdigit() alone takes other scripts' digits, int() doesn't
+        if not sep or not (digits.isascii() and digits.isdigit()):
+            # a malformed Range header is ignored
+            return None
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+        else:
+            # the last bytes of the file
+            start = max(size - int(last), 0)
+            end = size - 1 if int(last) else -1
+        if start < size and start <= end:
+            ranges.append((start, min(end, size - 1) - start + 1))
+    return ranges
+
+
+def http_if_range(entry, value):
+    """
+    True if the If-Range validator matches the file. Only strong validators
+    count: an entity tag must be equal to a strong ETag, a date to the
+    Last-Modified of a file that has not just been modified
+    """
+    value = value.strip().encode("latin-1")
+    if entry.etag.startswith(b'W/'):
+        return False
+    if value.startswith(b'"'):
+        return value == entry.etag
+    return value == entry.last_modified
+
+
+def http_partial_gen(entry, header, content_type, ranges, date=None, conn='Close'):
+    """
+    Generate the response parts for byte ranges of a file: 416 if there
+    are none, 206 with the range for one and multipart/byteranges for more
+    """
+    if date is None:
+        date = http_date.get()
+    general = b'Date: ' + date + b'\r\n' + \
+        GENERAL_HEADER.format(servername=header.get("Host"), conn=conn).encode("utf-8")
+    size = entry.size
+    if not ranges:
+        return [b'HTTP/1.1 416 Range Not Satisfiable\r\nContent-Length: 0\r\n' +
+                b'Content-Range: bytes */%d\r\n' % size + general + b'\r\n']
+    bodies = http_range_body_gen(entry, ranges)
+    validators = http_entity_header(entry, content_type)
+    if len(ranges) == 1:
+        offset, count = ranges[0]
+        head = STATUS_HEADER.format(code='206',
+                                    explain='Partial Content',
+                                    length=count,
+                                    type=content_type).encode("utf-8") + \
+            CONTENT_RANGE_HEADER % (offset, offset + count - 1, size)
+        return [head + validators + general + b'\r\n', bodies[0]]
+    boundary = os.urandom(8).hex()
+    parts = []
+    length = 0
+    for (offset, count), body in zip(ranges, bodies):
+        part_header = ('\r\n--{}\r\nContent-Type: {}\r\n'.format(boundary, content_type)
+                       ).encode("utf-8") + \
+            CONTENT_RANGE_HEADER % (offset, offset + count - 1, size) + b'\r\n'
+        parts += [part_header, body]
+        length += len(part_header) + count
+    closing = '\r\n--{}--\r\n'.format(boundary).encode("utf-8")
+    parts.append(closing)
+    length += len(closing)
+    head = STATUS_HEADER.format(code='206',
+                                explain='Partial Content',
+                                length=length,
+                                type='multipart/byteranges; boundary=' + boundary).encode("utf-8")
+    return [head + validators + general + b'\r\n'] + parts
+
+
+def http_range_body_gen(entry, ranges):
+    """
+    Returns the bodies of byte ranges, sliced from the cached body or the
+    mapping of the file, or as regions of the file sent with sendfile().
+    The regions share one open file, closed with the last of them
+    """
+    if entry.body is not None:
+        return [entry.body[offset:offset + count] for offset, count in ranges]
+    view = entry.mapped_view()
+    if view is not None:
+        return [view[offset:offset + count] for offset, count in ranges]
+    file = open(entry.path, "rb")
+    last = len(ranges) - 1
+    return [asyncore_epoll.file_chunk(file, offset, count, close=i == last)
+            for i, (offset, count) in enumerate(ranges)]
+
+
+def http_cached_response(entry, method, header, content_type, date=None, conn='Close'):
+    """
+    Returns the whole response for a file with cached body, serialized once
+    per method, Host and Connection and afterwards only re-dated
+    """
+    key = (method, header.get("Host"), conn)
+    if date is None:
+        date = http_date.get()
+    response = FILE_CACHE.get_response(entry, key, date)
+    if response is None:
+        response = http_header_gen(entry, header, content_type, date, conn) + b'\r\n'
+        if method != 'head':
+            response += entry.body
+        FILE_CACHE.put_response(entry, key, response, date)
+    return response
 
 
 def http_parse_file_name(request_line):
@@ -289,37 +889,7 @@ def http_content_type(ext):
     return mimetypes.types_map['.' + ext]
 
 
-def http_req_line_parser(line):
-    """
-    Parsing uri line
-    :param request line:
-    :return:
-    """
-    try:
-        req, header_only = line.split('\r\n', 1)
-        return req, header_only
-    except Exception:
-        raise HTTPError(400, 'Bad request', 'Malformed request line')
-
-
-def http_parse_header(headers_alone):
-    """
-    Parsing header messages
-    """
-    return Parser().parsestr(headers_alone)
-
-
-def http_parse_request_line(req):
-    """
-    Analyze the first line of header
-    """
-    if len(req.split()) != 3:
-        raise HTTPError(400, 'Bad request', 'Malformed request line')
-    method, target, ver = req.split()
-    return method.lower(), target, ver
-
-
-def http_status_error_response(method, target, ver, path, ext):
+def http_status_error_response(method, target, ver, ext):
     """
     Error validator
     """
@@ -329,8 +899,6 @@ def http_status_error_response(method, target, ver, path, ext):
         raise HTTPError(405, 'Method Not Allowed')
     if re.findall(r'/\.\.', unquote(target)):
         raise HTTPError(400, 'Bad request', 'Too long path name')
-    if not os.path.exists(path):
-        raise HTTPError(404, 'Not Found')
     if ext not in ACC_MIME:
         raise HTTPError(404, 'Not Found', 'Content-type not support')
 
@@ -351,14 +919,14 @@ class HTTPError(Exception):
         res_body = DEFAULT_ERROR_MESSAGE.format(code=self.status,
                                                 message=self.body,
                                                 explain=self.reason).encode("utf-8")
-        resposne_header = HEADER.format(code=self.status,
-                                        explain=self.reason,
-                                        date=self.date,
-                                        servername=self.servername,
-                                        length=len(res_body),
-                                        type='Not Implemented',
-                                        conn='Close').encode("utf-8")
-        response = resposne_header + b'\r\n' + res_body + b'\r\n'
+        resposne_header = STATUS_HEADER.format(code=self.status,
+                                               explain=self.reason,
+                                               length=len(res_body),
+                                               type='Not Implemented').encode("utf-8")
+        resposne_header += b'Date: ' + (self.date or http_date.get()) + b'\r\n'
+        resposne_header += GENERAL_HEADER.format(servername=self.servername,
+                                                 conn='Close').encode("utf-8")
+        response = resposne_header + b'\r\n' + res_body
         return response
 
 
@@ -369,6 +937,21 @@ def main():
     op.add_option("-g", "--logdir", action="store", type=str, help="From where will be processed logs",
                   default='.')
     op.add_option("-l", "--log", action="store", type=str, help="Log filename.", default="app_webserver.log")
+    op.add_option("--header-timeout", action="store", type=float, default=HEADER_TIMEOUT,
+                  help="Seconds to receive the request line and headers")
+    op.add_option("--body-timeout", action="store", type=float, default=BODY_TIMEOUT,
+                  help="Seconds to receive the request body")
+    op.add_option("--write-timeout", action="store", type=float, default=WRITE_TIMEOUT,
+                  help="Seconds a response may wait for the client to read")
+    op.add_option("-c", "--max-connections", action="store", type=int, default=MAX_CONNECTIONS,
+                  help="Open connections, the listening socket is paused beyond")
+    op.add_option("--latency-budget", action="store", type=float, default=LATENCY_BUDGET,
+                  help="Answer with 503 when a request would wait longer than this many "
+                       "seconds for a worker, 0 disables")
+    op.add_option("--mmap-size", action="store", type=int, default=0,
+                  help="Map files too large for the in-memory cache up to this many bytes "
+                       "instead of using sendfile(), 0 disables. Truncating a mapped file "
+                       "crashes the server")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log,
                         filemode='w',
@@ -377,7 +960,13 @@ def main():
 
     httpd = MyHTTPServer("0.0.0.0", 8080, "Myserver")
     httpd_server = httpd.http_server_init()
-    poller = PollQueue(httpd_server, http_processor, 1)
+    poller = PollQueue(httpd_server, http_processor, int(opts.worker))
+    poller.header_timeout = opts.header_timeout
+    poller.body_timeout = opts.body_timeout
+    poller.write_timeout = opts.write_timeout
+    poller.max_connections = opts.max_connections
+    poller.latency_budget = opts.latency_budget
+    FILE_CACHE.max_mmap_size = opts.mmap_size
     # Choose OS
     if "darwin" == platform:
         logging.info("Starting webserver...")
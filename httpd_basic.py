@@ -1,13 +1,20 @@
 import logging
 import mimetypes
 import os
-from datetime import datetime
+import signal
+import time
 import multiprocessing as mp
+from email.utils import parsedate_to_datetime
 from optparse import OptionParser
 from urllib.parse import unquote
+import socket
+from errno import EMFILE, ENFILE, ENOBUFS, ENOMEM
 import asyncore_epoll
+import compression
+import http_date
+from file_cache import FileCache
 from sys import platform
-from email.parser import Parser
+from http_parser import RequestParser, ParseError
 
 op = OptionParser()
 op.add_option("-w", "--worker", action="store", type=str, help="Setup worker count",
@@ -15,6 +22,28 @@ op.add_option("-w", "--worker", action="store", type=str, help="Setup worker cou
 op.add_option("-g", "--logdir", action="store", type=str, help="From where will be processed logs",
               default='.')
 op.add_option("-l", "--log", action="store", type=str, help="Log filename.", default="app_webserver.log")
+op.add_option("-e", "--edge", action="store_true", help="Use edge-triggered epoll", default=False)
+op.add_option("-s", "--shared", action="store_true", default=False,
+              help="Share one listening socket between workers (EPOLLEXCLUSIVE) instead of SO_REUSEPORT")
+op.add_option("-b", "--backlog", action="store", type=int, help="Listen backlog", default=100)
+op.add_option("-a", "--accept-batch", action="store", type=int, default=64,
+              help="Connections accepted per readiness event")
+op.add_option("--header-timeout", action="store", type=float, default=10,
+              help="Seconds to receive the request line and headers")
+op.add_option("--body-timeout", action="store", type=float, default=30,
+              help="Seconds to receive the request body")
+op.add_option("--idle-timeout", action="store", type=float, default=5,
+              help="Seconds to wait for the next request on a persistent connection")
+op.add_option("--write-timeout", action="store", type=float, default=30,
+              help="Seconds a response may wait for the client to read")
+op.add_option("-c", "--max-connections", action="store", type=int, default=1024,
+              help="Connections per worker, the listening socket is paused beyond")
+op.add_option("--latency-budget", action="store", type=float, default=0,
+              help="Answer new connections with 503 while the event loop lags more than this "
+                   "many seconds, 0 disables")
+op.add_option("--mmap-size", action="store", type=int, default=0,
+              help="Map files too large for the in-memory cache up to this many bytes instead of "
+                   "using sendfile(), 0 disables. Truncating a mapped file crashes the worker")
 (opts, args) = op.parse_args()
 
 logging.basicConfig(filename=opts.log,
@@ -23,8 +52,43 @@ logging.basicConfig(filename=opts.log,
                     format="%(created)-15s %(msecs)d %(levelname)8s %(thread)d %(name)s %(message)s")
 log = logging.getLogger(__name__)
 
-BACKLOG = 5
+BACKLOG = opts.backlog
+ACCEPT_BATCH = opts.accept_batch
 SIZE = 1024
+# Persistent connections: seconds to wait for the next request and the
+# number of requests served on one connection before it is closed
+KEEPALIVE_TIMEOUT = opts.idle_timeout
+KEEPALIVE_REQUESTS = 100
+# Slow clients: seconds allowed for the head and the body of a request, and
+# without progress while sending a response
+HEADER_TIMEOUT = opts.header_timeout
+BODY_TIMEOUT = opts.body_timeout
+WRITE_TIMEOUT = opts.write_timeout
+# Overload: open connections per worker, loop lag above which new
+# connections are turned away, how often the lag is measured, how long
+# accepting pauses when the process runs out of file descriptors, and how
+# long a turned away connection is kept for its 503 to be read
+MAX_CONNECTIONS = opts.max_connections
+LATENCY_BUDGET = opts.latency_budget
+LAG_INTERVAL = 0.1
+ACCEPT_RETRY = 0.5
+REJECT_LINGER = 1
+# Pre-fork master: seconds between restarts of a crashing worker, between
+# load reports, and granted to a stopping worker to finish its requests
+RESTART_DELAY = 1
+REPORT_INTERVAL = 10
+DRAIN_TIMEOUT = 30
+# Per-worker load counters shared with the master: connections, requests,
+# connections closed by each timeout and connections turned away with 503
+(STAT_ACTIVE, STAT_CONNECTIONS, STAT_REQUESTS, STAT_HEADER_TIMEOUT, STAT_BODY_TIMEOUT,
+ STAT_IDLE_TIMEOUT, STAT_WRITE_TIMEOUT, STAT_REJECTED) = range(8)
+STAT_COUNT = 8
+TIMEOUT_NAMES = {STAT_HEADER_TIMEOUT: 'header',
+                 STAT_BODY_TIMEOUT: 'body',
+                 STAT_IDLE_TIMEOUT: 'idle',
+                 STAT_WRITE_TIMEOUT: 'write'}
+# Closed connection handlers kept for reuse per worker
+MAX_FREE_HANDLERS = 1024
 
 DEFAULT_ERROR_MESSAGE = """\
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
@@ -43,12 +107,30 @@ DEFAULT_ERROR_MESSAGE = """\
 </html>\r
 """
 
-HEADER = """\
+# Status line and entity headers come first, so that they can be prebuilt
+# once per cached file
+STATUS_HEADER = """\
 HTTP/1.1 {code} {explain}\r
-Date: {date}\r
-Server: {servername}\r
 Content-Length: {length}\r
 Content-Type: {type}\r
+"""
+
+# Validators of a file, sent with it and with 304 responses
+VALIDATOR_HEADER = b"ETag: %s\r\nLast-Modified: %s\r\n"
+
+# Representations of compressible files, see compression
+CONTENT_ENCODING_HEADER = b"Content-Encoding: %s\r\n"
+VARY_HEADER = b"Vary: Accept-Encoding\r\n"
+
+# Files are sent whole or by byte ranges, see http_ranges()
+ACCEPT_RANGES_HEADER = b"Accept-Ranges: bytes\r\n"
+CONTENT_RANGE_HEADER = b"Content-Range: bytes %d-%d/%d\r\n"
+# A request for more ranges than this gets the whole file
+MAX_RANGES = 16
+
+# The Date header is added as preencoded bytes, see http_date
+GENERAL_HEADER = """\
+Server: {servername}\r
 Connection: {conn}\r
 """
 
@@ -65,29 +147,61 @@ ACC_MIME = ['css', 'html', 'js', 'jpg', 'jpeg', 'png', 'gif', 'swf', 'txt']
 
 DEFAULT_TIMEOUT = 0
 
-DATE = datetime.now().strftime("%a %d %b %Y, %H:%M:%S GMT")
+FILE_CACHE = FileCache(max_mmap_size=opts.mmap_size)
+ENCODER = compression.Encoder(FILE_CACHE)
+
 
+class EchoHandler(asyncore_epoll.dispatcher_with_send):
+    __slots__ = ('server', 'client_address', 'parser', 'is_readable', 'keep_alive',
+                 'requests_served', 'timer')
 
-class EchoHandler(asyncore_epoll.dispatcher):
+    # Closed handlers waiting to be reused for new connections, with their
+    # parser and its buffer
+    free_list = []
+    # Reads land here and are copied straight into the parser's buffer, so
+    # one buffer serves every connection of the loop
+    recv_view = memoryview(bytearray(SIZE))
 
     def __init__(self, conn_sock, client_address, server):
+        self.parser = RequestParser()
+        self.setup(conn_sock, client_address, server)
+
+    @classmethod
+    def create(cls, conn_sock, client_address, server):
+        """
+        Return a handler for a new connection, reusing a closed one if any
+        """
+        if cls.free_list:
+            handler = cls.free_list.pop()
+            handler.setup(conn_sock, client_address, server)
+            return handler
+        return cls(conn_sock, client_address, server)
+
+    def setup(self, conn_sock, client_address, server):
         self.server = server
         self.client_address = client_address
-        self.buffer = b""
 
         self.is_readable = True
-        # We dont have anything to write, to start with
-        self.is_writable = False
+        self.keep_alive = False
+        self.requests_served = 0
+        # Closes the connection if whatever it waits for takes too long
+        self.timer = None
 
         # Create ourselves, but with an already provided socket
-        asyncore_epoll.dispatcher.__init__(self, conn_sock)
+        asyncore_epoll.dispatcher_with_send.__init__(self, conn_sock)
+        if self.connected:
+            server.stats[STAT_ACTIVE] += 1
+            server.stats[STAT_CONNECTIONS] += 1
+            self.set_timeout(HEADER_TIMEOUT, STAT_HEADER_TIMEOUT)
         log.debug("created handler; waiting for loop")
 
     def readable(self):
-        return self.is_readable
+        # Stop reading while responses are queued, pipelined requests wait
+        # in the buffer until the socket has taken them
+        return self.is_readable and not self.out_buffer
 
-    def writable(self):
-        return self.is_writable
+    # writable() comes from dispatcher_with_send: we want write events
+    # only while a response is queued
 
     def handle_connect(self):
         log.info("#################")
@@ -95,31 +209,109 @@ class EchoHandler(asyncore_epoll.dispatcher):
 
     def handle_read(self):
         log.debug("handle read")
-        data = self.recv(SIZE)
+        nbytes = self.recv_into(self.recv_view)
         log.debug("after recv")
-        if data:
+        if nbytes:
             log.debug("got data")
-            self.buffer += data
-            if self.buffer.endswith(b'\r\n\r\n'):
-                self.is_writable = True  # sth to send back now
-                self.is_readable = False
+            self.parser.feed(self.recv_view[:nbytes])
+            if self.process_requests():
+                self.flush()
+            elif self.connected:
+                self.wait_for_request()
         else:
             log.debug("got null data")
 
+    def process_requests(self):
+        # Answer every complete request in the buffer, in order. Their
+        # responses are queued and written together by flush()
+        count = 0
+        while self.is_readable:
+            try:
+                request = self.parser.next_request()
+            except ParseError as e:
+                # the rest of the stream can't be framed
+                request = e
+            if request is None:
+                break
+            self.requests_served += 1
+            self.server.stats[STAT_REQUESTS] += 1
+            self.clear_timeout()
+            count += 1
+            if isinstance(request, ParseError):
+                message, self.keep_alive = [http_error_gen(request)], False
+            else:
+                message, self.keep_alive = self._processor(
+                    request,
+                    keep_alive=self.requests_served < KEEPALIVE_REQUESTS and not self.server.draining)
+            for part in message:
+                self.push(part)
+            if not self.keep_alive:
+                # anything pipelined after this request is dropped
+                self.is_readable = False
+        return count
+
     def handle_write(self):
         log.debug("handle_write")
-        message = self._processor(self.buffer)
-        if message:
-            while len(message) != 0:
-                sent = self.send(message)
-                message = message[sent:]
+        self.flush()
+
+    def flush(self):
+        # Send as much of the responses as the socket takes, the rest is
+        # sent from the loop on the next write events
+        while True:
+            self.initiate_send()
+            if not self.connected:
+                return
+            if self.out_buffer:
+                # Restarted whenever the client takes part of the response
+                self.set_timeout(WRITE_TIMEOUT, STAT_WRITE_TIMEOUT)
+                return
             log.debug("sent data")
-            self.is_writable = False
-            self.is_readable = True
+            if not self.keep_alive:
+                self.handle_close()
+            elif self.process_requests():
+                continue
+            else:
+                self.wait_for_request()
+            return
+
+    def wait_for_request(self):
+        # The head and the body of a request each have to arrive within
+        # their timeout, however slowly the bytes trickle in
+        if self.parser.reading_body():
+            if self.timeout_reason() != STAT_BODY_TIMEOUT:
+                self.set_timeout(BODY_TIMEOUT, STAT_BODY_TIMEOUT)
+        elif self.parser.pending():
+            if self.timeout_reason() != STAT_HEADER_TIMEOUT:
+                self.set_timeout(HEADER_TIMEOUT, STAT_HEADER_TIMEOUT)
+        elif self.server.draining:
             self.handle_close()
-
         else:
-            log.debug("nothing to send")
+            self.set_timeout(KEEPALIVE_TIMEOUT, STAT_IDLE_TIMEOUT)
+
+    def drain(self):
+        # The server is shutting down: close now if we are between
+        # requests, otherwise after the current response
+        if self.timeout_reason() == STAT_IDLE_TIMEOUT:
+            self.handle_close()
+
+    def set_timeout(self, delay, reason):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncore_epoll.call_later(delay, self.handle_timeout, reason)
+
+    def clear_timeout(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def timeout_reason(self):
+        return self.timer.args[0] if self.timer is not None else None
+
+    def handle_timeout(self, reason):
+        log.debug("%s timeout" % TIMEOUT_NAMES[reason])
+        self.timer = None
+        self.server.stats[reason] += 1
+        self.handle_close()
 
     def handle_close(self):
         log.debug("handle_close")
@@ -129,36 +321,78 @@ class EchoHandler(asyncore_epoll.dispatcher):
         self.close()
         # pass
 
+    def close(self):
+        self.clear_timeout()
+        reusable = self.connected
+        if reusable:
+            self.server.stats[STAT_ACTIVE] -= 1
+        asyncore_epoll.dispatcher_with_send.close(self)
+        # Only recycle on the first close, a handler must never be in the
+        # free list twice
+        if reusable and len(self.free_list) < MAX_FREE_HANDLERS:
+            self.parser.reset()
+            self.free_list.append(self)
+
     @staticmethod
-    def _processor(buffer, date=DATE, document_root=''):
-        # Accept the browser sent me the http request
+    def _processor(request, date=None, document_root='', keep_alive=True):
+        # Answer a parsed request, returns the response parts and whether
+        # the connection persists
+        if date is None:
+            date = http_date.get()
         try:
-            request_str = buffer.decode('utf-8')
-            req, header_alone = http_req_line_parser(request_str)
-            req_header = http_parse_header(header_alone)
-            method, target, ver = http_parse_request_line(req)
+            method, target, ver = request.method.lower(), request.target, request.version
+            req_header = request.headers
+            keep_alive = keep_alive and http_keep_alive(ver, req_header)
             file_name = http_parse_file_name(unquote(target))
             path = check_for_long_path(os.path.join(file_name), document_root)
             ext = get_filename_ext(path)
-            http_status_error_response(method, target, ver, path, ext)
+            http_status_error_response(method, target, ver, ext)
+            entry = FILE_CACHE.lookup(path)
+            if entry is None:
+                raise HTTPError(404, 'Not Found')
             content_type = http_content_type(ext)
-            header = http_header_gen(path, req_header, content_type)
+            conn = 'keep-alive' if keep_alive else 'Close'
+            if compression.compressible(content_type):
+                entry = ENCODER.select(entry, req_header.get("Accept-Encoding"))
+            if http_not_modified(entry, req_header):
+                return [http_not_modified_gen(entry, req_header, content_type, date, conn)], \
+                    keep_alive
+            ranges = http_ranges(entry, req_header) if method == 'get' else None
+            if ranges is not None:
+                return http_partial_gen(entry, req_header, content_type, ranges,
+                                        date, conn), keep_alive
+            if entry.body is not None:
+                return [http_cached_response(entry, method, req_header, content_type,
+                                             date, conn)], keep_alive
+            header = http_header_gen(entry, req_header, content_type, date, conn)
             if method == 'head':
-                return header + b'\r\n'
-            body = http_body_gen(path, content_type)
-            return header + b'\r\n' + body + b'\r\n'
+                return [header + b'\r\n'], keep_alive
+            body = http_body_gen(entry, content_type)
+            return [header + b'\r\n', body], keep_alive
         except Exception as e:
-            if hasattr(e, 'status'):
-                err = HTTPError(e.status, e.reason, e.body, date, 'Error')
-                logging.error("ERROR Occurred status - {}, reason - {}, date - {}, host - {}".format(e.status,
-                                                                                                     e.reason,
-                                                                                                     date,
-                                                                                                     'Error'))
-            else:
-                err = HTTPError('405', 'Method Not Implemented', 'Request Error', date)
-                logging.error(
-                    "ERROR Occured status - 405, reason - Method Not Implemented, date - {}".format(date))
-            return err.error_content()
+            # a missing file is the only error that leaves the request
+            # stream in a known state
+            keep_alive = keep_alive and getattr(e, 'status', None) == 404
+            return [http_error_gen(e, date, 'keep-alive' if keep_alive else 'Close')], keep_alive
+
+
+def http_error_gen(e, date=None, conn='Close'):
+    """
+    Generate the error response for an exception raised by the processor
+    """
+    if date is None:
+        date = http_date.get()
+    if hasattr(e, 'status'):
+        err = HTTPError(e.status, e.reason, e.body, date, 'Error')
+        logging.error("ERROR Occurred status - {}, reason - {}, date - {}, host - {}".format(e.status,
+                                                                                             e.reason,
+                                                                                             date.decode(),
+                                                                                             'Error'))
+    else:
+        err = HTTPError('405', 'Method Not Implemented', 'Request Error', date)
+        logging.error(
+            "ERROR Occured status - 405, reason - Method Not Implemented, date - {}".format(date.decode()))
+    return err.error_content(conn)
 
 
 def check_for_long_path(path, document_root):
@@ -170,31 +404,226 @@ def check_for_long_path(path, document_root):
     return document_root
 
 
-def http_body_gen(path, content_type):
+def http_body_gen(entry, content_type):
     """
-    Returns body of opened file
+    Returns cached body of the file, a view of its mapping, or the opened
+    file to be sent with sendfile() by the handler
     """
-    if 'image' or 'application' in content_type:
-        with open(path, "rb") as f:
-            body = f.read()
-    else:
-        with open(path, "r") as f:
-            body = f.read().encode("utf-8")
-    return body
+    if entry.body is not None:
+        return entry.body
+    view = entry.mapped_view()
+    if view is not None:
+        return view
+    # Content-Length is entry.size: no more is sent if the file has grown,
+    # and the connection is closed if it has been truncated
+    return asyncore_epoll.file_chunk(open(entry.path, "rb"), count=entry.size)
 
 
-def http_header_gen(path, header, content_type, date=DATE):
+def http_header_gen(entry, header, content_type, date=None, conn='Close'):
     """
-    Generate and return header
+    Generate and return header, the status line and entity headers are
+    built once per cache entry
     """
-    header = HEADER.format(code='200',
-                           explain='OK',
-                           date=date,
-                           servername=header.get("Host"),
-                           length=os.path.getsize(path),
-                           type=content_type,
-                           conn='Close').encode("utf-8")
-    return header
+    if entry.header is None:
+        entry.header = STATUS_HEADER.format(code='200',
+                                            explain='OK',
+                                            length=entry.size,
+                                            type=content_type).encode("utf-8") + \
+            http_entity_header(entry, content_type) + ACCEPT_RANGES_HEADER
+    if date is None:
+        date = http_date.get()
+    return entry.header + b'Date: ' + date + b'\r\n' + \
+        GENERAL_HEADER.format(servername=header.get("Host"), conn=conn).encode("utf-8")
+
+
+def http_keep_alive(ver, header):
+    """
+    HTTP/1.1 connections persist unless the client asks to close,
+    HTTP/1.0 ones only with "Connection: keep-alive"
+    """
+    conn = (header.get("Connection") or '').lower()
+    if ver == 'HTTP/1.0':
+        return 'keep-alive' in conn
+    return 'close' not in conn
+
+
+def http_not_modified(entry, header):
+    """
+    True if the client's copy of the file is current. If-None-Match is
+    compared weakly with the ETag, If-Modified-Since only counts without it
+    """
+    if_none_match = header.get("If-None-Match")
+    if if_none_match is not None:
+        etag = entry.etag[2:] if entry.etag.startswith(b'W/') else entry.etag
+        for tag in if_none_match.split(','):
+            tag = tag.strip().encode("latin-1")
+            if tag == b'*' or tag == etag or tag == b'W/' + etag:
+                return True
+        return False
+    if_modified_since = header.get("If-Modified-Since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # a date in the future is invalid
+    return int(entry.mtime) <= since <= time.time()
+
+
+def http_entity_header(entry, content_type):
+    """
+    Validators and coding of the representation of a file that is sent
+    """
+    entity = VALIDATOR_HEADER % (entry.etag, entry.last_modified)
+    if entry.encoding is not None:
+        entity += CONTENT_ENCODING_HEADER % entry.encoding.encode("ascii")
+    if compression.compressible(content_type):
+        entity += VARY_HEADER
+    return entity
+
+
+def http_not_modified_gen(entry, header, content_type, date=None, conn='Close'):
+    """
+    Generate a 304 response, it carries the validators but no body
+    """
+    if date is None:
+        date = http_date.get()
+    vary = VARY_HEADER if compression.compressible(content_type) else b''
+    return b'HTTP/1.1 304 Not Modified\r\n' + \
+        VALIDATOR_HEADER % (entry.etag, entry.last_modified) + vary + \
+        b'Date: ' + date + b'\r\n' + \
+        GENERAL_HEADER.format(servername=header.get("Host"), conn=conn).encode("utf-8") + b'\r\n'
+
+
+def http_ranges(entry, header):
+    """
+    Byte ranges of the file asked for with the Range header, as (offset,
+    count) pairs. None means the whole file is sent: there is no usable
+    Range header or If-Range doesn't match the file. An empty list means
+    that none of the ranges can be satisfied.
+    """
+    value = header.get("Range")
+    if value is None:
+        return None
+    if_range = header.get("If-Range")
+    if if_range is not None and not http_if_range(entry, if_range):
+        return None
+    unit, sep, specs = value.partition('=')
+    specs = specs.split(',')
+    if not sep or unit.strip().lower() != 'bytes' or len(specs) > MAX_RANGES:
+        return None
+    size = entry.size
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        digits = first + last
+        # isdigit() alone takes other scripts' digits, int() doesn't
+        if not sep or not (digits.isascii() and digits.isdigit()):
+            # a malformed Range header is ignored
+            return None
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+        else:
+            # the last bytes of the file
+            start = max(size - int(last), 0)
+            end = size - 1 if int(last) else -1
+        if start < size and start <= end:
+            ranges.append((start, min(end, size - 1) - start + 1))
+    return ranges
+
+
+def http_if_range(entry, value):
+    """
+    True if the If-Range validator matches the file. Only strong validators
+    count: an entity tag must be equal to a strong ETag, a date to the
+    Last-Modified of a file that has not just been modified
+    """
+    value = value.strip().encode("latin-1")
+    if entry.etag.startswith(b'W/'):
+        return False
+    if value.startswith(b'"'):
+        return value == entry.etag
+    return value == entry.last_modified
+
+
+def http_partial_gen(entry, header, content_type, ranges, date=None, conn='Close'):
+    """
+    Generate the response parts for byte ranges of a file: 416 if there
+    are none, 206 with the range for one and multipart/byteranges for more
+    """
+    if date is None:
+        date = http_date.get()
+    general = b'Date: ' + date + b'\r\n' + \
+        GENERAL_HEADER.format(servername=header.get("Host"), conn=conn).encode("utf-8")
+    size = entry.size
+    if not ranges:
+        return [b'HTTP/1.1 416 Range Not Satisfiable\r\nContent-Length: 0\r\n' +
+                b'Content-Range: bytes */%d\r\n' % size + general + b'\r\n']
+    bodies = http_range_body_gen(entry, ranges)
+    validators = http_entity_header(entry, content_type)
+    if len(ranges) == 1:
+        offset, count = ranges[0]
+        head = STATUS_HEADER.format(code='206',
+                                    explain='Partial Content',
+                                    length=count,
+                                    type=content_type).encode("utf-8") + \
+            CONTENT_RANGE_HEADER % (offset, offset + count - 1, size)
+        return [head + validators + general + b'\r\n', bodies[0]]
+    boundary = os.urandom(8).hex()
+    parts = []
+    length = 0
+    for (offset, count), body in zip(ranges, bodies):
+        part_header = ('\r\n--{}\r\nContent-Type: {}\r\n'.format(boundary, content_type)
+                       ).encode("utf-8") + \
+            CONTENT_RANGE_HEADER % (offset, offset + count - 1, size) + b'\r\n'
+        parts += [part_header, body]
+        length += len(part_header) + count
+    closing = '\r\n--{}--\r\n'.format(boundary).encode("utf-8")
+    parts.append(closing)
+    length += len(closing)
+    head = STATUS_HEADER.format(code='206',
+                                explain='Partial Content',
+                                length=length,
+                                type='multipart/byteranges; boundary=' + boundary).encode("utf-8")
+    return [head + validators + general + b'\r\n'] + parts
+
+
+def http_range_body_gen(entry, ranges):
+    """
+    Returns the bodies of byte ranges, sliced from the cached body or the
+    mapping of the file, or as regions of the file sent with sendfile().
+    The regions share one open file, closed with the last of them
+    """
+    if entry.body is not None:
+        return [entry.body[offset:offset + count] for offset, count in ranges]
+    view = entry.mapped_view()
+    if view is not None:
+        return [view[offset:offset + count] for offset, count in ranges]
+    file = open(entry.path, "rb")
+    last = len(ranges) - 1
+    return [asyncore_epoll.file_chunk(file, offset, count, close=i == last)
+            for i, (offset, count) in enumerate(ranges)]
+
+
+def http_cached_response(entry, method, header, content_type, date=None, conn='Close'):
+    """
+    Returns the whole response for a file with cached body, serialized once
+    per method, Host and Connection and afterwards only re-dated
+    """
+    key = (method, header.get("Host"), conn)
+    if date is None:
+        date = http_date.get()
+    response = FILE_CACHE.get_response(entry, key, date)
+    if response is None:
+        response = http_header_gen(entry, header, content_type, date, conn) + b'\r\n'
+        if method != 'head':
+            response += entry.body
+        FILE_CACHE.put_response(entry, key, response, date)
+    return response
 
 
 def http_parse_file_name(request_line):
@@ -229,37 +658,7 @@ def http_content_type(ext):
     return mimetypes.types_map['.' + ext]
 
 
-def http_req_line_parser(line):
-    """
-    Parsing uri line
-    :param request line:
-    :return:
-    """
-    try:
-        req, header_only = line.split('\r\n', 1)
-        return req, header_only
-    except Exception:
-        raise HTTPError(400, 'Bad request', 'Malformed request line')
-
-
-def http_parse_header(headers_alone):
-    """
-    Parsing header messages
-    """
-    return Parser().parsestr(headers_alone)
-
-
-def http_parse_request_line(req):
-    """
-    Analyze the first line of header
-    """
-    if len(req.split()) != 3:
-        raise HTTPError(400, 'Bad request', 'Malformed request line')
-    method, target, ver = req.split()
-    return method.lower(), target, ver
-
-
-def http_status_error_response(method, target, ver, path, ext):
+def http_status_error_response(method, target, ver, ext):
     """
     Error validator
     """
@@ -267,9 +666,6 @@ def http_status_error_response(method, target, ver, path, ext):
         raise HTTPError(505, 'HTTP Version Not Supported')
     if method not in ['get', 'head']:
         raise HTTPError(405, 'Method Not Allowed')
-
-    if not os.path.exists(path):
-        raise HTTPError(404, 'Not Found')
     if ext not in ACC_MIME:
         raise HTTPError(404, 'Not Found', 'Content-type not support')
 
@@ -287,30 +683,81 @@ class HTTPError(Exception):
         self.date = date
         self.servername = servername
 
-    def error_content(self):
+    def error_content(self, conn='Close'):
         res_body = DEFAULT_ERROR_MESSAGE.format(code=self.status,
                                                 message=self.body,
                                                 explain=self.reason).encode("utf-8")
-        resposne_header = HEADER.format(code=self.status,
-                                        explain=self.reason,
-                                        date=self.date,
-                                        servername=self.servername,
-                                        length=len(res_body),
-                                        type='Not Implemented',
-                                        conn='Close').encode("utf-8")
-        response = resposne_header + b'\r\n' + res_body + b'\r\n'
+        resposne_header = STATUS_HEADER.format(code=self.status,
+                                               explain=self.reason,
+                                               length=len(res_body),
+                                               type='Not Implemented').encode("utf-8")
+        resposne_header += b'Date: ' + (self.date or http_date.get()) + b'\r\n'
+        resposne_header += GENERAL_HEADER.format(servername=self.servername,
+                                                 conn=conn).encode("utf-8")
+        response = resposne_header + b'\r\n' + res_body
         return response
 
 
+class RejectedConnection(asyncore_epoll.dispatcher):
+    """
+    A connection answered with 503 without being served. The request is
+    read and discarded until the client closes or REJECT_LINGER expires:
+    closing with unread data resets the connection, and the client could
+    lose the response.
+    """
+
+    def __init__(self, sock):
+        asyncore_epoll.dispatcher.__init__(self, sock)
+        self.timer = asyncore_epoll.call_later(REJECT_LINGER, self.close)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        while self.recv_into(EchoHandler.recv_view):
+            pass
+
+    def close(self):
+        self.timer.cancel()
+        asyncore_epoll.dispatcher.close(self)
+
+
+def refresh_date():
+    # Regenerate the Date header at the start of every second
+    asyncore_epoll.call_later(http_date.refresh(), refresh_date)
+
+
 class EchoServer(asyncore_epoll.dispatcher):
     _allow_reuse_port = True
-    request_queue_size = 100
+    request_queue_size = BACKLOG
+    accept_batch = ACCEPT_BATCH
+    max_connections = MAX_CONNECTIONS
+    latency_budget = LATENCY_BUDGET
 
-    def __init__(self, address, handlerClass=EchoHandler):
+    def __init__(self, address, handlerClass=EchoHandler, stats=None, listener=None):
         self.address = address
         self.handlerClass = handlerClass
+        # active connections, connections and requests, see STAT_*
+        self.stats = stats if stats is not None else [0] * STAT_COUNT
+        self.draining = False
+        # Accepting is paused until then after running out of descriptors
+        self.accept_paused = False
+        # How late the event loop runs timers, i.e. how long a new request
+        # would wait before being looked at
+        self.loop_lag = 0.0
+        if self.latency_budget:
+            self.check_lag(time.monotonic())
 
         asyncore_epoll.dispatcher.__init__(self)
+        if listener is not None:
+            # Listening socket created by the master and shared with the
+            # other workers, only wake one of them per connection
+            self.poll_exclusive = True
+            listener.setblocking(0)
+            self.set_socket(listener)
+            self.addr = address
+            self.accepting = True
+            return
         self.create_socket()
 
         if self._allow_reuse_port:
@@ -330,13 +777,27 @@ class EchoServer(asyncore_epoll.dispatcher):
     def fileno(self):
         return self.socket.fileno()
 
+    def readable(self):
+        # Stop polling the listening socket at the connection limit, new
+        # connections wait in the backlog or go to other workers
+        return not self.accept_paused and self.stats[STAT_ACTIVE] < self.max_connections
+
+    def check_lag(self, scheduled):
+        now = time.monotonic()
+        self.loop_lag = now - scheduled
+        asyncore_epoll.call_at(now + LAG_INTERVAL, self.check_lag, now + LAG_INTERVAL)
+
     def serve_forever(self):
         if "darwin" == platform:
             logging.info("Starting webserver...")
             poller = asyncore_epoll.kqueue_poller
+        elif opts.edge:
+            logging.info("Starting webserver (edge-triggered)...")
+            poller = asyncore_epoll.epoll_et_poller
         else:
             logging.info("Starting webserver...")
             poller = asyncore_epoll.epoll_poller
+        refresh_date()
         asyncore_epoll.loop(poller=poller)
 
     def handle_request(self):
@@ -344,37 +805,279 @@ class EchoServer(asyncore_epoll.dispatcher):
 
     # # Internal use
     def handle_accept(self):
-        (conn_sock, client_address) = self.accept()
-        if self.verify_request(conn_sock, client_address):
-            self.process_request(conn_sock, client_address)
+        # Drain the backlog up to accept_batch connections per wakeup, a
+        # burst of connections would otherwise cost one poll per connection
+        self.read_blocked = False
+        for i in range(self.accept_batch):
+            if not self.readable():
+                break
+            try:
+                pair = self.accept()
+            except OSError as e:
+                if e.errno not in (EMFILE, ENFILE, ENOBUFS, ENOMEM):
+                    raise
+                # Out of descriptors or memory: the connection stays in the
+                # backlog, try again once some have been released
+                log.error("accept: %s, pausing for %ss" % (e, ACCEPT_RETRY))
+                self.accept_paused = True
+                asyncore_epoll.call_later(ACCEPT_RETRY, self.resume_accept)
+                break
+            if pair is None:
+                if self.read_blocked:
+                    break
+                # the connection was aborted before we got to it
+                continue
+            (conn_sock, client_address) = pair
+            if self.verify_request(conn_sock, client_address):
+                self.process_request(conn_sock, client_address)
+
+    def resume_accept(self):
+        self.accept_paused = False
 
     def verify_request(self, conn_sock, client_address):
+        if self.latency_budget and self.loop_lag > self.latency_budget:
+            self.reject(conn_sock)
+            return False
         return True
 
+    def reject(self, conn_sock):
+        # Overloaded: answer right away rather than let the request wait
+        # longer than the latency budget
+        self.stats[STAT_REJECTED] += 1
+        try:
+            conn_sock.send(HTTPError(503, 'Service Unavailable', 'Server overloaded',
+                                     servername='Error').error_content())
+            conn_sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            conn_sock.close()
+            return
+        RejectedConnection(conn_sock)
+
     def process_request(self, conn_sock, client_address):
         log.info("conn_made: client_address=%s:%s" % \
                  (client_address[0],
                   client_address[1]))
-        self.handlerClass(conn_sock, client_address, self)
+        self.handlerClass.create(conn_sock, client_address, self)
 
     def handle_close(self):
         log.info("connection closed")
         self.close()
 
+    def shutdown(self):
+        """
+        Stop accepting and let the open connections finish, the loop ends
+        with the last one or after DRAIN_TIMEOUT
+        """
+        if self.draining:
+            return
+        self.draining = True
+        log.info("draining: %d connections" % self.stats[STAT_ACTIVE])
+        # Take the connections the kernel has already queued for this
+        # socket, they would be reset when it is closed. A shared socket
+        # stays open in the master and is served by the other workers.
+        if not self.poll_exclusive:
+            for i in range(self.request_queue_size // self.accept_batch + 1):
+                self.handle_accept()
+                if self.read_blocked:
+                    break
+        self.close()
+        for obj in list(self._map.values()):
+            if isinstance(obj, EchoHandler):
+                obj.drain()
+        asyncore_epoll.call_later(DRAIN_TIMEOUT, asyncore_epoll.close_all, self._map, True)
+
+
+class SignalWakeup(asyncore_epoll.dispatcher):
+    """
+    Drains the worker on SIGTERM. The signal only wakes up the poll through
+    signal.set_wakeup_fd(), the server is shut down from the loop, which may
+    have been interrupted in the middle of walking the socket map or the
+    timer heap.
+    """
+
+    def __init__(self, server):
+        reader, self.writer = socket.socketpair()
+        asyncore_epoll.dispatcher.__init__(self, reader)
+        self.writer.setblocking(False)
+        self.server = server
+        signal.signal(signal.SIGTERM, lambda signum, frame: None)
+        signal.set_wakeup_fd(self.writer.fileno())
+
+    def writable(self):
+        return False
 
-def worker():
+    def handle_read(self):
+        # the wakeup fd receives the numbers of the signals caught
+        if signal.SIGTERM in self.recv(64):
+            # the loop ends once the connections are closed, don't keep it
+            signal.set_wakeup_fd(-1)
+            self.close()
+            self.writer.close()
+            self.server.shutdown()
+
+
+def worker(cpu=None, stats=None, ready=None, listener=None):
+    # The master's SIGTERM handler only sets its own flag, until SignalWakeup
+    # takes over SIGTERM must still stop the worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Pin the worker to its CPU, the master assigns them round-robin
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    # Forked from the master, don't run its signal handlers. Ctrl-C reaches
+    # the whole process group, the master turns it into a drain of the
+    # workers with SIGTERM.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
     interface = "0.0.0.0"
     port = 8080
-    server = EchoServer((interface, port))
+    server = EchoServer((interface, port), stats=stats, listener=listener)
+    SignalWakeup(server)
+    if ready is not None:
+        ready.set()
     server.serve_forever()
 
 
+class WorkerProcess:
+    """
+    A worker started by the master and its shared load counters
+    """
+
+    def __init__(self, slot, cpu, listener=None):
+        self.slot = slot
+        self.cpu = cpu
+        self.stats = mp.RawArray('q', STAT_COUNT)
+        self.ready = mp.Event()
+        self.started = time.monotonic()
+        self.process = mp.Process(target=worker, args=(cpu, self.stats, self.ready, listener),
+                                  daemon=True)
+        self.process.start()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+
+class Supervisor:
+    """
+    Pre-fork master: keeps `count` workers running, restarts the ones that
+    die, replaces all of them on SIGHUP without dropping requests, and
+    logs their load every REPORT_INTERVAL seconds
+
+    With `shared` the master opens the listening socket and all workers
+    accept from it, otherwise each worker binds its own with SO_REUSEPORT
+    """
+
+    def __init__(self, count, shared=False):
+        self.count = count
+        self.listener = None
+        if shared:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(("0.0.0.0", 8080))
+            self.listener.listen(BACKLOG)
+        if hasattr(os, 'sched_getaffinity'):
+            self.cpus = sorted(os.sched_getaffinity(0))
+        else:
+            self.cpus = [None]
+        self.workers = {}
+        # Workers of previous generations finishing their requests
+        self.retired = []
+        self._reload = False
+        self._stop = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for slot in range(self.count):
+            self.spawn(slot)
+        next_report = time.monotonic() + REPORT_INTERVAL
+        while not self._stop:
+            time.sleep(0.5)
+            if self._stop:
+                # the workers may already be draining, e.g. after a SIGTERM
+                # sent to the whole process group: don't respawn them
+                break
+            if self._reload:
+                self._reload = False
+                self.reload()
+            self.reap()
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report = time.monotonic() + REPORT_INTERVAL
+        self.stop()
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+    def spawn(self, slot):
+        cpu = self.cpus[slot % len(self.cpus)]
+        w = self.workers[slot] = WorkerProcess(slot, cpu, self.listener)
+        log.info("worker %d started: pid=%d cpu=%s" % (slot, w.pid, cpu))
+        return w
+
+    def reap(self):
+        for slot, w in list(self.workers.items()):
+            if w.process.is_alive():
+                continue
+            if w.process.exitcode is not None and w.ready is not None:
+                # 0 is a worker that drained, e.g. after a SIGTERM of its own
+                report = log.info if w.process.exitcode == 0 else log.error
+                report("worker %d (pid %d) exited with code %s" % (slot, w.pid, w.process.exitcode))
+                # Report a crashing worker only once
+                w.ready = None
+            # Don't restart a worker that keeps crashing in a tight loop
+            if not self._stop and time.monotonic() - w.started >= RESTART_DELAY:
+                self.spawn(slot)
+        for w in self.retired[:]:
+            if not w.process.is_alive():
+                log.info("worker pid=%d drained" % w.pid)
+                self.retired.remove(w)
+
+    def reload(self):
+        log.info("reload: starting %d new workers" % self.count)
+        old = list(self.workers.values())
+        for slot in range(self.count):
+            self.spawn(slot)
+        # Old workers only stop accepting once the new ones are listening
+        for w in self.workers.values():
+            w.ready.wait(DRAIN_TIMEOUT)
+        for w in old:
+            self.terminate(w)
+            self.retired.append(w)
+
+    def terminate(self, w):
+        if w.process.is_alive():
+            os.kill(w.pid, signal.SIGTERM)
+
+    def report(self):
+        for slot, w in sorted(self.workers.items()):
+            timeouts = " ".join("%s=%d" % (name, w.stats[i]) for i, name in TIMEOUT_NAMES.items())
+            log.info("worker %d pid=%d cpu=%s: active=%d connections=%d requests=%d rejected=%d "
+                     "timeouts: %s" % (slot, w.pid, w.cpu, w.stats[STAT_ACTIVE],
+                                       w.stats[STAT_CONNECTIONS], w.stats[STAT_REQUESTS],
+                                       w.stats[STAT_REJECTED], timeouts))
+        if self.retired:
+            log.info("%d retired workers draining" % len(self.retired))
+
+    def stop(self):
+        log.info("stopping %d workers" % len(self.workers))
+        workers = list(self.workers.values()) + self.retired
+        for w in workers:
+            self.terminate(w)
+        for w in workers:
+            w.process.join(DRAIN_TIMEOUT)
+            if w.process.is_alive():
+                w.process.kill()
+        if self.listener is not None:
+            self.listener.close()
+
+
 def main():
-    workers = [mp.Process(target=worker, daemon=True) for i in range(int(opts.worker))]
-    for p in workers:
-        p.start()
-    for p in workers:
-        p.join()
+    Supervisor(int(opts.worker), opts.shared).run()
 
 
 if __name__ == '__main__':